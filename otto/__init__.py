@@ -37,6 +37,11 @@ Other env variables you may care about have default values, but may be overridde
 
 * `otto.home` - the path where the Otto environment is set up on the server.
   Defaults to `/usr/local/share/otto`.
+* `otto.cache_dir` - local directory where builds keep state between runs, such
+  as the manifest used by incremental blog builds. Relative to the fabfile.
+  Defaults to `.otto-cache`. Add it to your .gitignore.
+* `otto.pretty_json` - set to True to indent the JSON files Otto writes.
+  Defaults to False, for compact output.
 * `otto.httpserver` - which web server you run. Defaults to "apache2". Any web
   server that follows Debian setup conventions should work. "nginx" is known to
   work.
@@ -67,6 +72,8 @@ DEFAULT_CONFIG = {
     'otto.requirements_file': 'requirements.txt',
     'otto.httpserver': 'apache2',
     'otto.git.staging_branch': 'master',
+    'otto.cache_dir': '.otto-cache', # relative to fabfile
+    'otto.pretty_json': False,
     }
 for k, v in DEFAULT_CONFIG.iteritems():
     env.setdefault(k, v)
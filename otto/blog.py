@@ -24,7 +24,12 @@ Datetime fields are converted to timezone-aware Python datetime.datetime objects
 Inputs
 ------
 All files under the blog channel are considered inputs. All input files are
-passed to the output unchanged. Two types of inputs are treated specially:
+passed to the output unchanged. Files are only copied to the build if they
+changed since the last build, and files removed from the blog are removed from
+the build, along with the outputs made from them. Set
+`env['otto.blog.link_assets']` to "hardlink" or "reflink" to link unchanged
+files into the build instead of copying them (except for entries and channel
+metadata, which are always copied). Two types of inputs are treated specially:
 Channels and Entries. Each input of these types is processed to produce a
 separate output file for each configured output format. In the future, output
 formats will be configurable. Currently, they are hard-coded to include: JSON,
@@ -36,13 +41,40 @@ uses to compose the Channel. It is equivalent to a feedparser "feed" object,
 and keys are interpreted with the same semantics. As a metadata file,
 `channel.json` is not processed directly into alternate output formats.
 However, for each Channel, Otto produces an "index" output of each format,
-containing the Channel metadata and the 50 most recent entries in that channel
-(but excluding entries in any sub-channels).
+containing the Channel metadata and the 50 most recent entries in that channel,
+including entries in its sub-directories and sub-channels. Set
+`env['otto.blog.index_limit']` to change the number of entries (0 for all).
 
 An Entry is any file within a Channel that matches a valid EntryType for that
 Channel. In future this will be configurable. Currently, the only valid EntryTypes
 are Markdown files ('*.md') and JSON files ('*.json'). Markdown inputs are processed
-with the 'codehilite', 'extra', and 'meta' extensions.
+with the 'codehilite', 'extra', and 'meta' extensions. Converted Markdown is
+cached, see `otto.markup`.
+
+Tags
+----
+Entries list their tags in a `tags` header, separated by commas or spaces.
+Tags are case insensitive. For each tag, Otto produces an index of the entries
+with that tag, in each format, just like a channel index. Set
+`env['otto.blog.tag_dir']` to a directory in the blog (e.g. 'tags') to have
+tag indexes written there, named after the tag, e.g. `tags/python.html`.
+It must not be a directory of the blog source.
+They are rendered with the `env['otto.blog.html_tag_template']` and
+`env['otto.blog.atom_tag_template']` templates, by default the channel
+templates.
+
+Search
+------
+Set `env['otto.blog.search_dir']` to a directory in the blog (e.g. 'search') to
+have Otto write a static search index of all entries there, with a script
+to query it from the browser. See `otto.search`.
+
+Sitemaps
+--------
+Set `env['otto.blog.sitemap']` to a file name in the blog (e.g. 'sitemap.xml')
+to have Otto list every entry, channel and tag index there for search
+engines, in a sitemap index and as many sitemaps as it takes. See
+`otto.sitemap`.
 
 Outputs
 -------
@@ -54,8 +86,8 @@ appropriate for the format ('.json', '.html', '.atom').  If you use multiple
 extensions to take advantage of Apache's content negotiation, ensure the file
 type extension is the LAST one. Otherwise Otto will not recognize it.
 
-JSON output is generated using a custom JSON serializer. Sorry, no user customization
-available at this time.
+JSON output is generated using a custom JSON serializer. Output is compact. Set
+`env['otto.pretty_json']` to True to indent it for human readers instead.
 
 Atom output is generated by Jinja2 templates. At some point in the future,
 it may change to use a proper XML generator. Until then, this output may be
@@ -65,35 +97,132 @@ HTML output is generated using Jinja2 templates. To supply your own templates,
 set `env['otto.template_dir']` to their location. Otherwise, Otto will use its
 own rather spartan POSH templates (POSH = Plain Old Semantic HTML).
 
+Compiled templates are cached under `env['otto.cache_dir']`, so that each build
+does not have to compile them again. A template is compiled again whenever its
+source changes. Set `env['otto.blog.bytecode_cache']` to False to disable it.
+
+Incremental Builds
+------------------
+Set `env['otto.blog.incremental']` to True to rebuild only what changed. Otto
+records a manifest of each build under `env['otto.cache_dir']`: the size,
+mtime and hash of every input, the templates each output was rendered with,
+and the outputs produced. On the next build, entries whose input, channel
+metadata and templates are unchanged are not converted or rendered again, and
+a channel index is only rendered again if one of the entries it lists has
+changed or the set of entries it lists is different. Of the Markdown entries
+that are not rendered again, only the metadata header is read, for the
+indexes; their body is loaded from their JSON output if an index needs it.
+
+The templates recorded for each output include every template it extends,
+includes or imports. Changing a template re-renders only the outputs that
+used it, and only in that format: editing `entry.atom` (or `atom.jinja`,
+which it imports) re-renders Atom entries, but no HTML and no channels.
+Changing the site configuration forces a full build.
+
+Watch Mode
+----------
+`update_blog` rebuilds just the entries that changed and the indexes of the
+channels above them, using the manifest of the last incremental build. The
+`watch_blog` task in `otto.watch` uses it to keep a preview of the blog up to
+date as you edit.
+
+Build Statistics
+----------------
+Set `env['otto.blog.stats']` to True to print a summary of where the build
+spent its time: time per phase (sync, Markdown conversion, JSON load and
+save, rendering per format, channel indexing), counts of entries, channels,
+files and bytes written, and the slowest entries. The same report is saved as
+JSON under `env['otto.cache_dir']`. Set `env['otto.blog.cprofile']` to True to
+also save a cProfile dump of the build process there (use with a single
+worker, as the profile does not include worker processes).
+
+Parallel Builds
+---------------
+Set `env['otto.blog.workers']` to the number of processes to build with (0 for
+one per CPU). Markdown conversion and entry rendering are spread across a
+pool of worker processes. Channel indexes are rendered as soon as all of
+their entries are done, and the output is identical to a serial build.
+
 """
 from datetime import datetime
 from dateutil import tz, parser as dateparser
-from fabric.api import env, lcd, local, require, task as fabtask
+from fabric.api import abort, env, require, task as fabtask
 from feedparser import FeedParserDict # WARNING! Private internals!
+import collections
+import cProfile
 import fnmatch
-from jinja2 import Environment, FileSystemLoader
-import markdown
+import hashlib
+import heapq
+import itertools
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from jinja2 import meta as jinjameta
+import multiprocessing
 import os
 import os.path
-from otto.util import ancestor_of, slurp, dump, json_dump, json_load, paths
+import otto.markup as markup
+from otto.search import SearchIndex, document as search_doc
+from otto.sitemap import Sitemap
+from otto.instrument import stats
+from otto.util import ancestor_of, copy_file, digest, slurp, dump_iter, json_dump, \
+    json_dump_items, json_load, paths, sync_tree
 try:
     import simplejson as json
 except ImportError:
     import json
 import re
 import logging
+import tempfile
+import time
 
 DEFAULT_CONFIG = {
     'otto.blog.html_entry_template': 'entry.html',
     'otto.blog.html_channel_template': 'channel.html',
     'otto.blog.atom_entry_template': 'entry.atom',
     'otto.blog.atom_channel_template': 'channel.atom',
-    'otto.blog.template_dir': os.path.join( os.path.dirname(__file__), 'templates')
+    'otto.blog.html_tag_template': 'channel.html',
+    'otto.blog.atom_tag_template': 'channel.atom',
+    'otto.blog.tag_dir': None, # relative to the blog, e.g. 'tags'
+    'otto.blog.search_dir': None, # relative to the blog, e.g. 'search'
+    'otto.blog.sitemap': None, # relative to the blog, e.g. 'sitemap.xml'
+    'otto.blog.template_dir': os.path.join( os.path.dirname(__file__), 'templates'),
+    'otto.blog.incremental': False,
+    'otto.blog.workers': 1, # 0 means one per CPU
+    'otto.blog.markdown_cache': True,
+    'otto.blog.highlight_cache': True,
+    'otto.blog.link_assets': None, # or 'hardlink' or 'reflink'
+    'otto.blog.index_limit': 50, # 0 means no limit
+    'otto.blog.bytecode_cache': True,
+    'otto.blog.stats': False,
+    'otto.blog.cprofile': False,
     }
 for k, v in DEFAULT_CONFIG.iteritems():
     env.setdefault(k, v)
 
 
+class BytecodeCache(FileSystemBytecodeCache):
+    """Jinja2 bytecode cache that writes its files atomically.
+
+    Cache files are written to a temp file and renamed into place, so that
+    worker processes sharing the cache never read a partial file. Jinja
+    checks the template source checksum stored with the bytecode, so a cache
+    file is ignored (and replaced) as soon as its template changes.
+    """
+
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError: # another process made it
+                pass
+        super(BytecodeCache, self).__init__(directory)
+
+    def dump_bytecode(self, bucket):
+        fd, tmpname = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            bucket.write_bytecode(f)
+        os.rename(tmpname, self._get_cache_filename(bucket))
+
+
 # Module cache, only init Jinja once during run
 jinja = None
 def get_jinja():
@@ -102,29 +231,117 @@ def get_jinja():
         template_dirs = [ env['otto.blog.template_dir'] ]
         if env.has_key('otto.template_dir'):
             template_dirs.insert(0, env['otto.template_dir'])
+        bytecode_cache = None
+        if env['otto.blog.bytecode_cache']:
+            bytecode_cache = BytecodeCache(paths.cache_dir('jinja'))
         jinja = Environment(
             loader=FileSystemLoader(template_dirs),
             extensions=['jinja2.ext.loopcontrols', 'jinja2.ext.autoescape'],
             autoescape=True,
+            bytecode_cache=bytecode_cache,
             )
     return jinja
 
 
+# Module cache for template_dependencies. Reset once per build.
+template_deps = {}
+
+def template_dependencies(name):
+    """Return the set of templates rendering `name` needs: itself and every
+    template it extends, includes or imports, directly or not.
+
+    A name that is not a constant (e.g. `{% include entry.sidebar %}`) could be
+    any template, and is given as '*'.
+    """
+    if name not in template_deps:
+        jinja = get_jinja()
+        deps = template_deps[name] = set([name])
+        source, filename, uptodate = jinja.loader.get_source(jinja, name)
+        for ref in jinjameta.find_referenced_templates(jinja.parse(source)):
+            if ref is None:
+                deps.add('*')
+            else:
+                deps.update(template_dependencies(ref))
+    return template_deps[name]
+
+
+# Module cache for parse_datetime: the local timezone, the default for
+# missing date parts, and the datetimes already parsed. Reset once per build.
+local_tz = None
+default_datetime = None
+parsed_datetimes = {}
+PARSED_DATETIMES_MAX = 100000
+
+def reset_datetime_cache():
+    global local_tz, default_datetime
+    local_tz = tz.gettz()
+    # Use a timezone-aware default. Otherwise would get naive datetimes.
+    default_datetime = datetime.now(local_tz).replace(hour=0,minute=0,second=0,microsecond=0)
+    parsed_datetimes.clear()
+
+
+ISO_DATETIME = re.compile(r'(\d{4})-(\d\d)-(\d\d)'
+    r'(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6})\d*)?)?)?'
+    r'(Z|[+-]\d\d:?\d\d)?$')
+def parse_datetime(value):
+    """Parse a date string into a timezone-aware datetime. Raises ValueError if it can't.
+
+    ISO-8601 strings, like those written by `json_dump`, are parsed directly.
+    Anything else goes to dateutil. Parts missing from the string default to
+    midnight today in the local timezone. Results are memoized.
+    """
+    if default_datetime == None:
+        reset_datetime_cache()
+    dt = parsed_datetimes.get(value, None)
+    if dt == None:
+        match = ISO_DATETIME.match(value)
+        if match:
+            dt = _iso_datetime(*match.groups())
+        else:
+            dt = dateparser.parse(value, default=default_datetime)
+        if len(parsed_datetimes) >= PARSED_DATETIMES_MAX:
+            parsed_datetimes.clear()
+        parsed_datetimes[value] = dt
+    return dt
+
+def _iso_datetime(year, month, day, hour, minute, second, fraction, offset):
+    if offset == None:
+        tzinfo = local_tz
+    elif offset == 'Z':
+        tzinfo = tz.tzutc()
+    else:
+        seconds = int(offset[1:3]) * 3600 + int(offset[-2:]) * 60
+        if offset[0] == '-':
+            seconds = -seconds
+        tzinfo = tz.tzoffset(None, seconds) if seconds else tz.tzutc()
+    return datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0),
+        int(second or 0), int((fraction or '0').ljust(6, '0')), tzinfo=tzinfo)
+
+
 DATETIME_FIELDS = ['created', 'expired', 'published', 'updated']
 def normalize_datetimes(thing):
-    # Use a timezone-aware default. Otherwise would get naive datetimes.
-    default = datetime.now(tz.gettz()).replace(hour=0,minute=0,second=0,microsecond=0)
     for k in DATETIME_FIELDS:
         if thing.has_key(k):
+            if isinstance(thing[k], datetime):
+                continue
             try:
-                dt = dateparser.parse(thing[k], default=default)
-            except ValueError:
+                dt = parse_datetime(thing[k])
+            except (ValueError, OverflowError):
                 continue
             thing[k] = dt
             if not thing.has_key(k+'_parsed'):
                 thing[k+'_parsed'] = dt.timetuple()
 
 
+def count_output(outfile, written):
+    """Count an output file in the build stats, as written or unchanged."""
+    if written:
+        stats.count('files_written')
+        stats.count('bytes_written', os.path.getsize(outfile))
+    else:
+        stats.count('files_unchanged')
+
+
 class BlogThing(FeedParserDict):
     """Code shared by channels and entries."""
 
@@ -132,13 +349,18 @@ class BlogThing(FeedParserDict):
         """Return the channel containing the Thing. If the Thing IS a channel, returns itself."""
         if self['_metafile'].endswith('channel.json'):
             return self
+        if registry is not None:
+            channel = registry.channel_for(self['_metafile'])
+            if channel is not None:
+                return channel
         channel_dir = ancestor_of(self['_metafile'], containing='channel.json')
         return Channel.load_json(channel_dir)
 
     @classmethod
     def load_json(cls, filename):
         """Create an object and initialize from JSON file."""
-        thing = cls( json_load(filename) )
+        with stats.timer('json_load'):
+            thing = cls( json_load(filename) )
 
         # These properties are contextual, therefore calculated and not stored.
         mtime = datetime.utcfromtimestamp(os.path.getmtime(filename))
@@ -154,14 +376,18 @@ class BlogThing(FeedParserDict):
         return thing
 
     @classmethod
-    def load_markdown(cls, filename):
-        """Return an instance of BlogThing loaded from the given markdown file."""
-        md = markdown.Markdown(
-                extensions=['codehilite', 'extra', 'meta'],
-                output_format='html4',
-                )
-        body = md.convert( slurp(filename) )
-        metadata = md.Meta
+    def load_markdown(cls, filename, lazy=False):
+        """Return an instance of BlogThing loaded from the given markdown file.
+
+        If `lazy`, only the metadata header is read, and the body is converted
+        when first needed, see `load_body`.
+        """
+        if lazy:
+            with stats.timer('markdown_meta'):
+                body, metadata = None, markup.read_meta(filename)
+        else:
+            with stats.timer('markdown'):
+                body, metadata = markup.convert( slurp(filename) )
 
         # Markdown makes every value a list, just in case. I only want lists if the
         # thing claims to be a list.
@@ -175,7 +401,10 @@ class BlogThing(FeedParserDict):
         normalize_datetimes(thing)
 
         # http://packages.python.org/feedparser/reference-thing-content.html
-        thing['content'] = [ { 'value': body, 'type': 'text/html' } ]
+        if lazy:
+            thing['_lazy'] = True
+        else:
+            thing['content'] = [ { 'value': body, 'type': 'text/html' } ]
 
         # http://packages.python.org/feedparser/reference-thing-tags.html
         tag_list = re.split(r',?\s+', thing.pop('tags', ''))
@@ -190,19 +419,36 @@ class BlogThing(FeedParserDict):
             thing['_contentfile'] = thing['_metafile']
         return thing
 
+    def load_body(self):
+        """Convert the body of a thing loaded lazily from Markdown."""
+        with stats.timer('markdown'):
+            body, metadata = markup.convert( slurp(self['sourcefile']) )
+        self['content'] = [ { 'value': body, 'type': 'text/html' } ]
+        self.pop('_lazy')
+
     def save_json(self, outfile=None):
         """Write the JSON data (back) to disk."""
+        if self.get('_lazy'):
+            self.load_body()
         outfile = outfile or self['_metafile']
-        json_dump(self, outfile)
+        with stats.timer('json_save'):
+            written = json_dump(self, outfile)
+        count_output(outfile, written)
+
+    def output_filename(self, format='html'):
+        """Return the name of the file rendered for the given format."""
+        outfile, ext = os.path.splitext(self['_contentfile'])
+        return outfile + '.' + format
 
     def render_to(self, format='html', context={}, outfile=None):
         """Output an HTML file."""
         if not outfile:
-            outfile, ext = os.path.splitext(self['_contentfile'])
-            outfile = outfile + '.' + format
-        # TODO Only write outfile if entry file is newer
+            outfile = self.output_filename(format)
         template = self.get_template(format)
-        dump(template.render(self.context(context)), outfile)
+        # Stream the output, big channel pages need not fit in memory
+        with stats.timer('render_' + format):
+            written = dump_iter(template.generate(self.context(context)), outfile)
+        count_output(outfile, written)
 
     def context(self, context={}):
         return context
@@ -213,6 +459,8 @@ class BlogThing(FeedParserDict):
         Contrary to all feed specifications, I allow channels to have content
         too. This makes for handy introductory text on the channel index page.
         """
+        if self.get('_lazy'):
+            self.load_body()
         return ' '.join( [ x['value'] for x in self['content'] ] )
 
 
@@ -226,15 +474,22 @@ class Channel(BlogThing):
         return super(Channel, cls).load_json(filename)
 
     def save_json(self, outfile=None):
-        """Write the JSON data (back) to disk."""
-        # Default save location is metadata file, no entries there
-        entries = self.pop('entries', None)
-        super(Channel, self).save_json()
+        """Write the index.json of the channel, which has the entries, to disk.
 
-        # We also produce the index.json which does have the entries
+        `channel.json` is source metadata, copied to the build as it is, so
+        full and incremental builds leave the same file.
+        """
+        entries = self.pop('entries', None)
         if entries:
+            self.save_index_json(entries, outfile or self['_contentfile'])
             self['entries'] = entries
-            super(Channel, self).save_json(self['_contentfile'])
+
+    def save_index_json(self, entries, outfile):
+        """Write the JSON data with `entries` to disk, loading the entries
+        given as summaries one at a time."""
+        with stats.timer('json_save'):
+            written = json_dump_items(self, 'entries', load_entries(entries), outfile)
+        count_output(outfile, written)
  
     def context(self, context={}):
         context.update({ "channel": self })
@@ -247,15 +502,69 @@ class Channel(BlogThing):
         jinja = get_jinja()
         return jinja.get_template(template_name)
 
-    def url(self, absolute=False):
-        """URL to the channel, relative to /."""
-        channelpath = os.path.dirname(self.channel()['_metafile'])
-        relpath = os.path.relpath(paths.build_dir('htdocs'), channelpath)
-        if relpath == '.' and absolute:
-            return 'http://%s/' % env['otto.site']
-        if absolute:
-            return 'http://%s/%s/' % (env['otto.site'], relpath)
-        return relpath+'/'
+    def url(self, format=None, absolute=False):
+        """URL to the channel, relative to /. With a `format`, the URL of its
+        index in that format."""
+        if not self.has_key('_path'):
+            channelpath = os.path.dirname(self['_metafile'])
+            self['_path'] = os.path.relpath(channelpath, paths.build_dir('htdocs'))
+            if self['_path'] == '.':
+                self['_url'] = 'http://%s/' % env['otto.site']
+            else:
+                self['_url'] = 'http://%s/%s/' % (env['otto.site'], self['_path'])
+        url = self['_url'] if absolute else self['_path']+'/'
+        if format:
+            url = url + 'index.' + format
+        return url
+
+
+class Tag(Channel):
+    """Index of the entries with a given tag. Rendered like a channel, to
+    files named after the tag in the tag dir."""
+
+    def __init__(self, term, tag_dir):
+        super(Tag, self).__init__()
+        self['title'] = term
+        self['term'] = term
+        self['_metafile'] = os.path.join(tag_dir, tag_slug(term) + '.json')
+        self['_contentfile'] = self['_metafile']
+
+    def save_json(self, outfile=None):
+        """Write the JSON data, entries included, to disk."""
+        entries = self.pop('entries', [])
+        self.save_index_json(entries, outfile or self['_metafile'])
+        self['entries'] = entries
+
+    def get_template(self, format='html'):
+        return get_jinja().get_template(env['otto.blog.%s_tag_template' % format])
+
+    def url(self, format=None, absolute=False):
+        """URL to the tag index, relative to /."""
+        if not self.has_key('_path'):
+            self['_path'] = os.path.relpath(os.path.splitext(self['_contentfile'])[0],
+                paths.build_dir('htdocs'))
+            self['_url'] = 'http://%s/%s' % (env['otto.site'], self['_path'])
+        url = self['_url'] if absolute else self['_path']
+        if format:
+            url = url + '.' + format
+        return url
+
+
+def tag_terms(entry):
+    """The set of tags of an entry, lower case."""
+    return set( term.lower() for term in entry.topic_list() if term )
+
+
+def tag_slug(term):
+    """File name (sans extension) of the index of tag `term`.
+
+    Characters that do not belong in a file name are replaced, and a hash of
+    the tag appended, so that each tag still gets a file of its own.
+    """
+    slug = re.sub(r'[^\w.+-]+', '-', term, flags=re.UNICODE).strip('-.')
+    if slug != term:
+        slug = (slug and slug + '-') + hashlib.sha1(term.encode('utf-8')).hexdigest()[:8]
+    return slug
 
 
 class Entry(BlogThing):
@@ -282,13 +591,15 @@ class Entry(BlogThing):
 
     def url(self, format=None, absolute=False):
         """URL to the entry, relative to its channel."""
-        channelpath = os.path.dirname(self.channel()['_metafile'])
-        relpath = os.path.relpath(self['_contentfile'], channelpath)
-        url, ext = os.path.splitext(relpath)
+        if not self.has_key('_path'):
+            channel = self.channel()
+            channelpath = os.path.dirname(channel['_metafile'])
+            relpath = os.path.relpath(self['_contentfile'], channelpath)
+            self['_path'], ext = os.path.splitext(relpath)
+            self['_url'] = channel.url(absolute=True) + self['_path']
+        url = self['_url'] if absolute else self['_path']
         if format:
             url = url + '.' + format
-        if absolute:
-            return self.channel().url(absolute) + url
         return url
 
     def topic_list(self):
@@ -299,49 +610,895 @@ class Entry(BlogThing):
             return []
 
 
-# TODO 0.5 Accept date argument for incremental build
+class EntrySummary(object):
+    """Compact stand-in for an Entry in channel and tag indexes.
+
+    Holds what index templates mostly use (URL, title, summary, sort date and
+    tags) in slots, plus the JSON file the entry was saved to. Anything else,
+    such as `bodycontent()` in Atom feeds, loads the full entry from that file.
+    Only the last few entries loaded are kept, so a build holds a handful of
+    entry bodies at a time, rather than those of every entry an index lists.
+    """
+    __slots__ = ('title', 'summary', '_path', '_url', '_date', '_terms', '_jsonfile', '_entry')
+
+    def __init__(self, entry):
+        entry.url()
+        for k in ('title', 'summary'):
+            if entry.has_key(k):
+                setattr(self, k, entry[k])
+        self._path = entry['_path']
+        self._url = entry['_url']
+        self._date = entry.sort_date()
+        self._terms = tuple(entry.topic_list())
+        self._jsonfile = entry['_metafile']
+        self._entry = None
+
+    def load(self):
+        """Return the full Entry."""
+        if self._entry is None:
+            self._entry = Entry.load_json(self._jsonfile)
+            self._entry['_path'] = self._path
+            self._entry['_url'] = self._url
+            loaded_summaries.append(self)
+            if len(loaded_summaries) > LOADED_SUMMARIES_MAX:
+                loaded_summaries.popleft()._entry = None
+        return self._entry
+
+    def sort_date(self):
+        return self._date
+
+    def topic_list(self):
+        return list(self._terms)
+
+    def url(self, format=None, absolute=False):
+        url = self._url if absolute else self._path
+        if format:
+            url = url + '.' + format
+        return url
+
+    def bodycontent(self):
+        return self.load().bodycontent()
+
+    def get(self, key, default=None):
+        return self.load().get(key, default)
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+class TagEntry(object):
+    """An entry (or summary) as listed on a tag index. Its URLs are absolute,
+    since they are not relative to the tag dir, but to the entry's channel."""
+    __slots__ = ('entry',)
+
+    def __init__(self, entry):
+        self.entry = entry
+
+    def url(self, format=None, absolute=False):
+        return self.entry.url(format, True)
+
+    def __getitem__(self, key):
+        return self.entry[key]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.entry, name)
+
+
+def load_entries(entries):
+    """Iterate over `entries`, loading the full entries of summaries."""
+    for e in entries:
+        if isinstance(e, TagEntry):
+            e = e.entry
+        yield e.load() if isinstance(e, EntrySummary) else e
+
+
+# The summaries holding a loaded entry, oldest first
+loaded_summaries = collections.deque()
+LOADED_SUMMARIES_MAX = 16
+
+def release_entries():
+    """Drop the full entries loaded by summaries."""
+    while loaded_summaries:
+        loaded_summaries.popleft()._entry = None
+
+
+# Files the build reads or writes in place. Never hard linked to the source.
+BUILD_PATTERNS = ['*.md', '*.json', '*.html', '*.atom']
+
+
+class ChannelRegistry(dict):
+    """Map of directory to the Channel it contains, for every channel under `root`.
+
+    Built once per build, so that finding the channel of an entry costs a few
+    dictionary lookups instead of a walk up the file system and a JSON parse.
+    Channel URLs are computed as the channels are registered.
+    """
+
+    def __init__(self, root=None):
+        super(ChannelRegistry, self).__init__()
+        if root:
+            for thisdir, subdirs, files in os.walk(root):
+                if 'channel.json' in files:
+                    self.add(thisdir)
+
+    def add(self, dirname):
+        channel = Channel.load_json(dirname)
+        channel.url()
+        self[dirname] = channel
+
+    def add_ancestors(self, filename, root):
+        """Register the channels in the directories from `filename` up to `root`.
+
+        For when only a few channels are needed, rather than every one under `root`.
+        """
+        dirname = os.path.dirname(filename)
+        while True:
+            if dirname not in self and os.path.exists(os.path.join(dirname, 'channel.json')):
+                self.add(dirname)
+            if len(dirname) <= len(root) or dirname == os.path.dirname(dirname):
+                break
+            dirname = os.path.dirname(dirname)
+
+    def channel_for(self, filename):
+        """Return the nearest Channel containing `filename`, or None."""
+        dirname = os.path.dirname(filename)
+        while dirname not in self:
+            parent = os.path.dirname(dirname)
+            if parent == dirname:
+                return None
+            dirname = parent
+        return self[dirname]
+
+
+# The channels of the build in progress. Set by build_blog before the worker
+# pool is started, so workers share it.
+registry = None
+
+
+class BuildManifest(dict):
+    """Record of the inputs, templates and outputs of a blog build.
+
+    The manifest of the previous build is loaded from `filename` and kept in
+    `previous`. The manifest of the current build is accumulated in the
+    object itself as inputs are checked and outputs recorded, then written
+    back with `save`. Paths are stored relative to `root`.
+    """
+    VERSION = 2
+
+    # Settings that affect every output. If any of them change, all bets are off.
+    CONFIG_KEYS = ['otto.site', 'otto.template_dir', 'otto.blog.template_dir',
+        'otto.blog.html_entry_template', 'otto.blog.html_channel_template',
+        'otto.blog.atom_entry_template', 'otto.blog.atom_channel_template',
+        'otto.blog.html_tag_template', 'otto.blog.atom_tag_template', 'otto.blog.tag_dir',
+        'otto.pretty_json']
+
+    def __init__(self, filename, root):
+        super(BuildManifest, self).__init__()
+        self.filename = filename
+        self.root = root
+        self.previous = {}
+        if os.path.exists(filename):
+            try:
+                self.previous = json_load(filename)
+            except ValueError:
+                logging.warning("Ignoring corrupt build manifest " + filename)
+        if self.previous.get('version') != self.VERSION:
+            self.previous = {}
+        self['version'] = self.VERSION
+        self['config'] = dict( (k, env.get(k, None)) for k in self.CONFIG_KEYS )
+        self['templates'] = {}
+        self['inputs'] = {}
+        self['channels'] = {}
+        self['tags'] = {}
+        self._changed = {}
+        self._stats = {}
+
+    def relpath(self, filename):
+        return os.path.relpath(filename, self.root)
+
+    def requires_full_build(self):
+        """True if the previous build cannot be trusted for this one.
+
+        That is the case when there was no previous build, or when the
+        configuration differs.
+        """
+        if not self.previous:
+            return True
+        return self.previous.get('config') != self['config']
+
+    def template_changed(self, name):
+        """True if the source of the named template differs from the previous build."""
+        if name not in self['templates']:
+            source, filename, uptodate = get_jinja().loader.get_source(get_jinja(), name)
+            self['templates'][name] = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        return self['templates'][name] != self.previous.get('templates', {}).get(name)
+
+    def templates_changed(self, names):
+        """True if any of the named templates changed. '*' stands for all of them."""
+        if '*' in names:
+            names = get_jinja().list_templates()
+        return any(self.template_changed(name) for name in names)
+
+    def input_changed(self, filename):
+        """True if the input file differs from the previous build.
+
+        Size and mtime are checked first. The file is only hashed when they
+        differ, so touching a file without changing it does not cause a rebuild.
+        """
+        rel = self.relpath(filename)
+        if rel in self._changed:
+            return self._changed[rel]
+        stat = os.stat(filename)
+        old = self.previous.get('inputs', {}).get(rel, None) or \
+            self.previous.get('channels', {}).get(rel, None)
+        record = {'size': stat.st_size, 'mtime': stat.st_mtime}
+        if old and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime:
+            record['sha1'] = old['sha1']
+        else:
+            record['sha1'] = digest(filename)
+        changed = not old or old['sha1'] != record['sha1']
+        self._changed[rel] = changed
+        self._stats[rel] = record
+        return changed
+
+    def _missing(self, old, ext):
+        return [ outfile for outfile in old['outputs'] if outfile.endswith(ext) and
+            not os.path.exists(os.path.join(self.root, outfile)) ]
+
+    def json_missing(self, filename, section='inputs'):
+        """True if a JSON output of the input is missing, or was never recorded."""
+        old = self.previous.get(section, {}).get(self.relpath(filename), None)
+        return not old or bool(self._missing(old, '.json'))
+
+    def stale_formats(self, filename, formats, section='inputs'):
+        """Return the `formats` the input needs rendering to again.
+
+        That is, those whose output is missing or whose templates changed.
+        """
+        old = self.previous.get(section, {}).get(self.relpath(filename), None)
+        if not old:
+            return list(formats)
+        return [ f for f in formats if f not in old['templates'] or
+            self.templates_changed(old['templates'][f]) or self._missing(old, '.' + f) ]
+
+    def record(self, filename, thing, formats, section='inputs', **extra):
+        """Record the templates and outputs rendered for `thing` from the input `filename`.
+
+        Templates are recorded per format, with their dependencies.
+        """
+        self.input_changed(filename)
+        record = dict(self._stats[self.relpath(filename)])
+        record.update(self._rendered(thing, formats))
+        # Plus the JSON files, where they are not the input itself
+        for outfile in sorted(set([thing['_metafile'], thing['_contentfile']])):
+            if outfile != filename:
+                record['outputs'].append(self.relpath(outfile))
+        record.update(extra)
+        self[section][self.relpath(filename)] = record
+
+    def record_index(self, thing, formats, section, **extra):
+        """Record the outputs of an index that has no input of its own, such
+        as a tag index. It is recorded under its JSON output."""
+        record = self._rendered(thing, formats)
+        record['outputs'].append(self.relpath(thing['_metafile']))
+        record.update(extra)
+        self[section][self.relpath(thing['_metafile'])] = record
+
+    def _rendered(self, thing, formats):
+        return {
+            'templates': dict( (f, sorted(template_dependencies(thing.get_template(f).name)))
+                for f in formats ),
+            'outputs': [ self.relpath(thing.output_filename(f)) for f in formats ],
+            }
+
+    def remove_outputs(self, relpath, section):
+        """Delete the outputs recorded for `relpath` by the previous build."""
+        for outfile in self.previous[section][relpath]['outputs']:
+            outfile_path = os.path.join(self.root, outfile)
+            if os.path.exists(outfile_path):
+                logging.info("Removing " + outfile_path)
+                os.remove(outfile_path)
+
+    def keep(self, filename, section='inputs'):
+        """Carry the previous record for an unchanged input into this build."""
+        rel = self.relpath(filename)
+        self[section][rel] = self.previous[section][rel]
+
+    def channel_entries(self, filename):
+        """Inputs listed in the channel's index by the previous build."""
+        record = self.previous.get('channels', {}).get(self.relpath(filename), {})
+        return record.get('entries', None)
+
+    def remove_stale_outputs(self, keep=()):
+        """Delete the outputs of inputs of the previous build that no longer exist.
+
+        Outputs named in `keep` (relative paths) are left alone.
+        """
+        keep = set(keep)
+        for section in ('inputs', 'channels'):
+            for relpath, record in self.previous.get(section, {}).items():
+                if os.path.exists(os.path.join(self.root, relpath)):
+                    continue
+                for outfile in record['outputs']:
+                    outfile_path = os.path.join(self.root, outfile)
+                    if outfile not in keep and os.path.exists(outfile_path):
+                        logging.info("Removing " + outfile_path)
+                        os.remove(outfile_path)
+
+    def save(self):
+        # Hash every template, not only the ones rendered directly, so the next
+        # build can tell if any of them changed.
+        for name in get_jinja().list_templates():
+            self.template_changed(name)
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        json_dump(self, self.filename)
+
+
+def cache_filename(build_dir, suffix):
+    """Location of a cache file for a blog built into `build_dir`, e.g. its manifest."""
+    name = re.sub(r'\W+', '_', os.path.relpath(build_dir, paths.build_dir())).strip('_')
+    return paths.cache_dir('blog', (name or 'root') + suffix)
+
+
 @fabtask
 def build_blog(source_dir, dest_dir):
     """Build the blog"""
     require('otto.build_dir', 'otto.site')
-    if not source_dir.endswith('/'):
-        source_dir += '/'
+    source_dir = paths.local_workspace(source_dir.rstrip('/'))
     build_dir = paths.build_dir(dest_dir)
 
     logging.info("Processing " + source_dir)
-    with lcd(paths.local_workspace()):
-        local('mkdir -p %s' % build_dir)
-        local('cp -a %s %s' % (source_dir, build_dir))
-
-    # Walk the dir looking for markdown files and convert to JSON
-    for thisdir, subdirs, files in os.walk(build_dir):
-        for mdfile in fnmatch.filter(files, '*.md'):
-            # TODO Only write outfile if md file is newer
-            mdfilename = os.path.join(thisdir, mdfile)
-            entry = Entry.load_markdown(mdfilename)
+    started = time.time()
+    stats.reset()
+    profiler = cProfile.Profile() if env['otto.blog.cprofile'] else None
+    if profiler:
+        profiler.enable()
+
+    manifest = BuildManifest(cache_filename(build_dir, '.manifest.json'), build_dir)
+
+    # As with `cp -a`, the blog lands in a directory of the same name in the build dir.
+    # Then clear out what was built from files that have since been removed.
+    blog_dir = os.path.join(build_dir, os.path.basename(source_dir))
+    with stats.timer('sync'):
+        manifest['sources'] = sync_tree(source_dir, blog_dir,
+            previous=manifest.previous.get('sources', []),
+            link=env['otto.blog.link_assets'], nolink=BUILD_PATTERNS)
+        manifest.remove_stale_outputs(keep=[ manifest.relpath(os.path.join(blog_dir, f))
+            for f in manifest['sources'] ])
+
+    incremental = env['otto.blog.incremental'] and not manifest.requires_full_build()
+    if env['otto.blog.incremental'] and not incremental:
+        logging.info("No usable build manifest, building everything.")
+
+    global registry
+    registry = ChannelRegistry(build_dir)
+    reset_datetime_cache()
+    template_deps.clear()
+
+    # Compile the default templates up front, so worker processes inherit them
+    # rather than each compiling (or loading from the bytecode cache) their own.
+    for format in ['html', 'atom']:
+        for kind in ['entry', 'channel']:
+            get_jinja().get_template(env['otto.blog.%s_%s_template' % (format, kind)])
+    # The walk skips the directories Otto writes indexes to, which must not hold sources
+    tag_dir = env['otto.blog.tag_dir'] and os.path.join(blog_dir, env['otto.blog.tag_dir'])
+    search = get_search_index(build_dir, blog_dir)
+    for output_dir in (tag_dir, search and search.search_dir):
+        if output_dir:
+            prefix = os.path.relpath(output_dir, blog_dir) + os.sep
+            if any( (f + os.sep).startswith(prefix) for f in manifest['sources'] ):
+                abort("%s is a directory of the blog source, choose another for Otto's output."
+                    % output_dir)
+
+    workers = int(env['otto.blog.workers']) or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        sitemap = get_sitemap(build_dir, blog_dir)
+        _build_tree(build_dir, manifest, incremental, pool, tag_dir, search, sitemap)
+        if search:
+            with stats.timer('search'):
+                search.save()
+        if sitemap:
+            with stats.timer('sitemap'):
+                sitemap.save()
+    except:
+        # Don't let the queued jobs run before the error is reported
+        if pool:
+            pool.terminate()
+            pool.join()
+        raise
+    else:
+        if pool:
+            pool.close()
+            pool.join()
+    finally:
+        registry = None
+
+    manifest.save()
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(cache_filename(build_dir, '.prof'))
+    if env['otto.blog.stats']:
+        elapsed = time.time() - started
+        report = stats.as_dict()
+        report.update(elapsed=elapsed, workers=workers, incremental=bool(incremental),
+            finished=datetime.utcnow())
+        json_dump(report, cache_filename(build_dir, '.stats.json'), pretty=True)
+        print stats.summary(elapsed)
+
+
+def get_search_index(build_dir, blog_dir):
+    """The SearchIndex of the blog, or None if `otto.blog.search_dir` is not set."""
+    if not env['otto.blog.search_dir']:
+        return None
+    return SearchIndex(os.path.join(blog_dir, env['otto.blog.search_dir']),
+        cache_filename(build_dir, '.search.json'))
+
+
+def get_sitemap(build_dir, blog_dir):
+    """The Sitemap of the blog, or None if `otto.blog.sitemap` is not set."""
+    if not env['otto.blog.sitemap']:
+        return None
+    filename = os.path.join(blog_dir, env['otto.blog.sitemap'])
+    url = 'http://%s/%s' % (env['otto.site'],
+        os.path.relpath(filename, paths.build_dir('htdocs')).replace(os.sep, '/'))
+    return Sitemap(filename, url, cache_filename(build_dir, '.sitemap.json'))
+
+
+def search_document(entry):
+    """The search document and terms of an entry, see `otto.search.document`."""
+    path = os.path.relpath(entry.output_filename('html'), paths.build_dir('htdocs'))
+    if entry.get('_lazy'):
+        entry.load_body()
+    return search_doc(entry, '/' + path)
+
+
+def update_blog(source_dir, dest_dir, changed):
+    """Rebuild the blog after the source files in `changed` were modified.
+
+    Only the changed entries are rendered, along with the indexes of the
+    channels above them, which are updated from the entries they listed in the
+    last build. Anything beyond that (removed files, channel or template
+    changes, an entry dropping out of a full index, no usable manifest) falls
+    back to `build_blog`. Used by `otto.watch`.
+    """
+    require('otto.build_dir', 'otto.site')
+    source_dir = paths.local_workspace(source_dir.rstrip('/'))
+    build_dir = paths.build_dir(dest_dir)
+    stats.reset()
+    template_deps.clear()
+    global registry
+    registry = ChannelRegistry()
+    try:
+        updated = _update_entries(source_dir, build_dir, changed)
+    finally:
+        registry = None
+    if not updated:
+        logging.info("Changes need a build, building.")
+        build_blog(source_dir, dest_dir)
+
+
+def _update_entries(source_dir, build_dir, changed):
+    """The work of `update_blog`. Returns False if a build is needed instead."""
+    manifest = BuildManifest(cache_filename(build_dir, '.manifest.json'), build_dir)
+    if manifest.requires_full_build() or manifest.templates_changed(['*']):
+        return False
+    blog_dir = os.path.join(build_dir, os.path.basename(source_dir))
+
+    # Copy the changed files into the build, noting which are entries
+    copies = []
+    inputs = []
+    for filename in sorted(changed):
+        rel = os.path.relpath(filename, source_dir)
+        name = os.path.basename(filename)
+        if rel.startswith(os.pardir) or os.path.islink(filename) or \
+                not os.path.isfile(filename) or name == 'channel.json':
+            return False
+        outfile = os.path.join(blog_dir, rel)
+        siblings = os.listdir(os.path.dirname(filename))
+        if name == 'index.json' and 'channel.json' in siblings:
+            return False
+        copies.append( (filename, outfile) )
+        if outfile in entry_inputs(os.path.dirname(outfile), siblings):
+            inputs.append(outfile)
+    sources = set(manifest.previous.get('sources', []))
+    for filename, outfile in copies:
+        if not os.path.isdir(os.path.dirname(outfile)):
+            os.makedirs(os.path.dirname(outfile))
+        nolink = any(fnmatch.fnmatch(outfile, p) for p in BUILD_PATTERNS)
+        copy_file(filename, outfile, None if nolink else env['otto.blog.link_assets'])
+        sources.add(os.path.relpath(outfile, blog_dir))
+
+    # Carry over the last build, then render the entries that changed
+    manifest['sources'] = sorted(sources)
+    for section in ('inputs', 'channels'):
+        manifest[section] = dict(manifest.previous[section])
+    manifest['tags'] = dict(manifest.previous.get('tags', {}))
+    formats = ['html', 'atom']
+    rendered = {}
+    for inputfile in inputs:
+        if manifest.input_changed(inputfile):
+            registry.add_ancestors(inputfile, build_dir)
+            entry, entry_stats = _load_entry( (inputfile, True, formats) )
+            stats.merge(entry_stats)
+            manifest.record(inputfile, entry, formats)
+            rendered[manifest.relpath(inputfile)] = entry
+
+    # Update the index of every channel above them
+    limit = int(env['otto.blog.index_limit'] or 0)
+    loaded = {}
+    indexed = {} # index pages rendered, as (url, newest sort date)
+    channel_dirs = set( d for d in registry for rel in rendered
+        if os.path.join(build_dir, rel).startswith(d + os.sep) )
+    for thisdir in sorted(channel_dirs, reverse=True):
+        channel = registry[thisdir]
+        channelfile = channel['_metafile']
+        listed = manifest.channel_entries(channelfile)
+        if listed is None:
+            return False
+        run = _updated_run(build_dir, listed, rendered, loaded, limit,
+            lambda rel, entry: os.path.join(build_dir, rel).startswith(thisdir + os.sep))
+        if run is None:
+            return False
+        now_listed = [ rel for d, i, rel, e in run ]
+        if now_listed == listed and not set(rendered).intersection(now_listed):
+            continue
+
+        manifest.record(channelfile, channel, formats, 'channels', entries=now_listed)
+        stats.count('channels_rendered')
+        if run:
+            indexed[manifest.relpath(channelfile)] = (channel.url(absolute=True), run[-1][0])
+        _render_index(channel, [ e for d, i, rel, e in reversed(run) ], formats)
+
+    # And of every tag they have, or had
+    tag_dir = env['otto.blog.tag_dir'] and os.path.join(blog_dir, env['otto.blog.tag_dir'])
+    if tag_dir:
+        terms = set()
+        for entry in rendered.values():
+            terms.update(tag_terms(entry))
+        for record in manifest['tags'].values():
+            if set(rendered).intersection(record['entries']):
+                terms.add(record['term'])
+        for term in sorted(terms):
+            tag = Tag(term, tag_dir)
+            tag.url()
+            relpath = manifest.relpath(tag['_metafile'])
+            listed = manifest['tags'].get(relpath, {}).get('entries', [])
+            run = _updated_run(build_dir, listed, rendered, loaded, limit,
+                lambda rel, entry: term in tag_terms(entry))
+            if run is None:
+                return False
+            if not run:
+                manifest.remove_outputs(relpath, 'tags')
+                del manifest['tags'][relpath]
+                indexed[relpath] = None
+                continue
+            indexed[relpath] = (tag.url('html', True), run[-1][0])
+            _render_tag(manifest, tag, [ e for d, i, rel, e in run ],
+                [ rel for d, i, rel, e in run ], formats, formats)
+
+    search = get_search_index(build_dir, blog_dir)
+    if search:
+        if search.rebuild:
+            return False
+        with stats.timer('search'):
+            for rel, entry in rendered.iteritems():
+                search.add(rel, *search_document(entry))
+            search.save(prune=False)
+
+    sitemap = get_sitemap(build_dir, blog_dir)
+    if sitemap:
+        if sitemap.rebuild:
+            return False
+        with stats.timer('sitemap'):
+            for rel, entry in rendered.iteritems():
+                sitemap.add(rel, entry.url('html', True), entry.sort_date())
+            for rel, page in indexed.iteritems():
+                if page:
+                    sitemap.add(rel, *page)
+                else:
+                    sitemap.remove(rel)
+            sitemap.save(prune=False)
+
+    manifest.save()
+    return True
+
+
+def _updated_run(build_dir, listed, rendered, loaded, limit, belongs):
+    """Update an index of the last build for the entries rendered again.
+
+    `listed` are the inputs the index listed, oldest first, and `rendered`
+    maps inputs to the entries rendered again. `belongs(rel, entry)` tells
+    if one of those belongs in the index now. The other entries are loaded
+    as needed, and kept in `loaded` for other indexes.
+
+    Returns a run of (sort date, tie breaker, input, entry) as in
+    _build_tree, keeping the order of the last build for ties. Returns None
+    if the index cannot be known without a build.
+    """
+    run = []
+    for i, rel in enumerate(listed):
+        if rel not in rendered:
+            if rel not in loaded:
+                inputfile = os.path.join(build_dir, rel)
+                registry.add_ancestors(inputfile, build_dir)
+                entry, entry_stats = _load_entry( (inputfile, False, []) )
+                stats.merge(entry_stats)
+                loaded[rel] = EntrySummary(entry)
+            run.append( (loaded[rel].sort_date(), i, rel, loaded[rel]) )
+    for i, (rel, entry) in enumerate(sorted(rendered.items())):
+        if belongs(rel, entry):
+            run.append( (entry.sort_date(), len(listed) + i, rel, entry) )
+    if limit and len(listed) >= limit:
+        # Entries not listed are no newer than the oldest listed. If a listed
+        # entry is now older than that, or left the index, another may take its place.
+        others = [ d for d, i, rel, e in run if rel not in rendered ]
+        now = dict( (rel, d) for d, i, rel, e in run )
+        for rel in set(listed).intersection(rendered):
+            if rel not in now or not others or now[rel] < min(others):
+                return None
+    return newest(run, limit)
+
+
+def entry_inputs(dirname, files):
+    """Return the entry input files among `files` in `dirname`, in name order.
+
+    Markdown files are inputs. JSON files are inputs unless they are the JSON
+    output of a Markdown entry, or channel metadata or index files.
+    """
+    inputs = []
+    for name in sorted(files):
+        stem, ext = os.path.splitext(name)
+        if ext == '.md':
+            inputs.append(os.path.join(dirname, name))
+        elif ext == '.json':
+            if name == 'channel.json' or stem + '.md' in files:
+                continue
+            # The channel index left by a previous build is an output, not an entry
+            if name == 'index.json' and 'channel.json' in files:
+                continue
+            inputs.append(os.path.join(dirname, name))
+    return inputs
+
+
+def newest(items, limit=None):
+    """Return the `limit` largest of `items` (all if no limit) in ascending order."""
+    if limit:
+        items = heapq.nlargest(limit, items)
+        items.reverse()
+        return items
+    return sorted(items)
+
+
+def push_newest(heap, item, limit=None):
+    """Add `item` to `heap`, keeping only the `limit` largest items (all if no limit)."""
+    if not limit or len(heap) < limit:
+        heapq.heappush(heap, item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap, item)
+
+
+def merge_newest(runs, limit=None):
+    """Merge runs sorted in ascending order into one, keeping the `limit` largest items."""
+    if len(runs) == 1:
+        return runs[0]
+    merged = list(heapq.merge(*runs))
+    if limit:
+        return merged[-limit:]
+    return merged
+
+
+def _load_entry(job):
+    """Load an entry and render it to the given formats. Runs in the worker pool.
+
+    Markdown entries are converted and written to JSON, unless `convert` is
+    False, in which case the JSON written by a previous build is loaded instead,
+    keeping the modification time of the Markdown file.
+    If there is nothing to render either, the entry is only needed for indexes,
+    and only its metadata header is read.
+    """
+    inputfile, convert, formats = job
+    started = time.time()
+    if inputfile.endswith('.md'):
+        if convert:
+            entry = Entry.load_markdown(inputfile)
             entry.save_json()
+        elif not formats:
+            entry = Entry.load_markdown(inputfile, lazy=True)
+        else:
+            entry = Entry.load_json(re.sub(r'\.md$', '.json', inputfile))
+            # Dated by its source, as when converted, not by the JSON
+            entry['_modified'] = datetime.utcfromtimestamp(os.path.getmtime(inputfile))
+    else:
+        entry = Entry.load_json(inputfile)
+    entry.url()
+    if convert and env['otto.blog.search_dir']:
+        with stats.timer('search'):
+            entry['_search'] = search_document(entry)
+    for format in formats:
+        entry.render_to(format)
+    stats.count('entries')
+    if formats:
+        stats.count('entries_rendered')
+    stats.file_time(inputfile, time.time() - started)
+    return entry, stats.take()
+
 
-    # Now walk it again, converting each JSON file to HTML and Atom
-    entries = []
+def _build_tree(build_dir, manifest, incremental, pool=None, tag_dir=None, search=None,
+        sitemap=None):
+    """Load, render and index every entry, channel and tag under `build_dir`.
+
+    This is a single depth-first walk. Each entry is loaded once, and the
+    loaded entry is rendered to every format and added to the channel index
+    straight from memory. With a `pool`, loading and rendering entries is
+    spread across its worker processes. Results come back in walk order, so
+    channels see the same entries in the same order as in a serial build.
+
+    Tag indexes are written to `tag_dir`, if given. They are built from an
+    inverted index of tag to its newest entries, filled in as entries come
+    back, so each tag of each entry is handled once. Entries are also added
+    to the `search` index, if given, tokenized by the workers when converted,
+    and entries and indexes to the `sitemap`, if given.
+    """
+    imap = pool.imap if pool else itertools.imap
+    formats = ['html', 'atom']
+
+    # Plan the walk. Note how many entries come before each directory, so that
+    # each channel is handled once all entries up to its place in the walk
+    # are back from the pool.
+    jobs = []
+    walk = []
+    output_dirs = [ d for d in (tag_dir, search and search.search_dir) if d ]
     for thisdir, subdirs, files in os.walk(build_dir, topdown=False):
-        for entryfile in fnmatch.filter(files, '*.json'):
-            if entryfile == 'channel.json':
+        if any((thisdir + os.sep).startswith(d + os.sep) for d in output_dirs):
+            continue
+        for inputfile in entry_inputs(thisdir, files):
+            channel = registry.channel_for(inputfile)
+            convert = not incremental or manifest.input_changed(inputfile) or \
+                manifest.json_missing(inputfile)
+            if convert or (channel and manifest.input_changed(channel['_metafile'])):
+                render = formats
+            else:
+                render = manifest.stale_formats(inputfile, formats)
+            jobs.append( (inputfile, convert, render) )
+        walk.append( (thisdir, subdirs, len(jobs), 'channel.json' in files) )
+
+    # For each directory, keep the newest entries found in it and below it, as
+    # a run of (sort date, -walk position, entry summary) in ascending order.
+    # Ties thus come out in walk order when the run is reversed.
+    limit = int(env['otto.blog.index_limit'] or 0)
+    runs = {}
+    tags = {}
+    dirty = set()
+    results = imap(_load_entry, jobs)
+    position = 0
+    for thisdir, subdirs, done, is_channel in walk:
+        own = []
+        while position < done:
+            inputfile, convert, rendered = jobs[position]
+            entry, worker_stats = results.next()
+            stats.merge(worker_stats)
+            if search:
+                key = manifest.relpath(inputfile)
+                if convert or search.needs(key):
+                    search.add(key, *(entry.pop('_search', None) or search_document(entry)))
+                else:
+                    search.add(key)
+            if convert:
+                dirty.add(manifest.relpath(inputfile))
+            if rendered:
+                manifest.record(inputfile, entry, formats)
+            else:
+                manifest.keep(inputfile)
+
+            # Indexes only need a summary of the entry
+            summary = EntrySummary(entry)
+            own.append( (summary.sort_date(), -position, summary) )
+            if sitemap:
+                sitemap.add(manifest.relpath(inputfile), summary.url('html', True),
+                    own[-1][0])
+            if tag_dir:
+                for term in tag_terms(summary):
+                    push_newest(tags.setdefault(term, []), own[-1], limit)
+            position += 1
+
+        # Since this is a depth-first crawl, sub-directories have been done
+        # already. Merge their runs with the entries in this directory.
+        with stats.timer('index'):
+            subruns = [ runs.pop(os.path.join(thisdir, d)) for d in subdirs
+                if os.path.join(thisdir, d) in runs ]
+            runs[thisdir] = merge_newest([newest(own, limit)] + subruns, limit)
+
+        if is_channel:
+            stats.count('channels')
+            channel = registry[thisdir]
+            listed = [ manifest.relpath(jobs[-p][0]) for d, p, e in runs[thisdir] ] # p is -position
+            channelfile = channel['_metafile']
+            if sitemap and runs[thisdir]:
+                sitemap.add(manifest.relpath(channelfile), channel.url(absolute=True),
+                    runs[thisdir][-1][0])
+            changed = not incremental or manifest.input_changed(channelfile) or \
+                dirty.intersection(listed) or \
+                sorted(listed) != sorted(manifest.channel_entries(channelfile) or []) or \
+                manifest.json_missing(channelfile, 'channels')
+            render = formats if changed else \
+                manifest.stale_formats(channelfile, formats, 'channels')
+            if not render:
+                manifest.keep(channelfile, 'channels')
                 continue
-            entrypath = os.path.join(thisdir, entryfile)
-            entry = Entry.load_json(entrypath)
-            entries.append(entry)
-            entry.render_to('html')
-            entry.render_to('atom')
-
-        # Since this is a depth-first crawl, if we have reached the channel dir,
-        # we have already processed all the entries in this channel.
-        if os.path.exists( os.path.join(thisdir, 'channel.json')):
-            channel = Channel.load_json(thisdir)
-
-            # sort entries reverse chrono
-            entries.sort(key=Entry.sort_key, reverse=True)
-            channel['entries'] = entries
-            channel.save_json()
-            channel.render_to('html')
-            channel.render_to('atom')
 
+            manifest.record(channelfile, channel, formats, 'channels', entries=listed)
+
+            # reverse chrono
+            stats.count('channels_rendered')
+            _render_index(channel, [ e for d, p, e in reversed(runs[thisdir]) ], render)
+
+    if tag_dir:
+        _build_tags(tags, tag_dir, manifest, incremental, dirty, formats,
+            lambda p: manifest.relpath(jobs[-p][0]), sitemap)
+
+
+def _build_tags(tags, tag_dir, manifest, incremental, dirty, formats, input_at,
+        sitemap=None):
+    """Render the index of every tag in `tags`, a dict of tag to a heap of
+    its newest (sort date, -walk position, entry summary). Removes the indexes of
+    tags no longer used. `input_at(p)` gives the input at walk position -p.
+    Each tag index is added to the `sitemap`, if given.
+    """
+    for term in sorted(tags):
+        run = sorted(tags[term])
+        tag = Tag(term, tag_dir)
+        tag.url()
+        tagfile = tag['_metafile']
+        listed = [ input_at(p) for d, p, e in run ]
+        if sitemap:
+            sitemap.add(manifest.relpath(tagfile), tag.url('html', True), run[-1][0])
+        old = manifest.previous.get('tags', {}).get(manifest.relpath(tagfile), None)
+        changed = not incremental or not old or dirty.intersection(listed) or \
+            sorted(listed) != sorted(old['entries']) or manifest.json_missing(tagfile, 'tags')
+        render = formats if changed else manifest.stale_formats(tagfile, formats, 'tags')
+        if render:
+            _render_tag(manifest, tag, [ e for d, p, e in run ], listed, formats, render, changed)
+        else:
+            manifest.keep(tagfile, 'tags')
+
+    for relpath in manifest.previous.get('tags', {}):
+        if relpath not in manifest['tags']:
+            manifest.remove_outputs(relpath, 'tags')
+
+
+def _render_tag(manifest, tag, entries, listed, formats, render, save=True):
+    """Render a tag index of `entries` (oldest first) from the inputs `listed`,
+    to the formats in `render`, and save its JSON if `save`."""
+    if not os.path.isdir(os.path.dirname(tag['_metafile'])):
+        os.makedirs(os.path.dirname(tag['_metafile']))
+    manifest.record_index(tag, formats, 'tags', term=tag['term'], entries=listed)
+    stats.count('tags_rendered')
+    _render_index(tag, [ TagEntry(e) for e in reversed(entries) ], render, save)
+
+
+def _render_index(thing, entries, render, save=True):
+    """Render a channel or tag index of `entries` (newest first) to the
+    formats in `render`, and save its JSON if `save`.
+
+    The entries are only attached to the index while it is rendered, and the
+    full entries their summaries load are dropped afterwards.
+    """
+    thing['entries'] = entries
+    try:
+        if save:
+            thing.save_json()
+        for format in render:
+            thing.render_to(format)
+    finally:
+        del thing['entries']
+        release_entries()
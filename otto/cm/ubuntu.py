@@ -57,7 +57,7 @@ class Precise(object):
         """Packages for Apache"""
         pre = ''
         # Some modules are installed but not enabled. I use these.
-        post = 'a2enmod include && service apache2 reload'
+        post = 'a2enmod include headers && service apache2 reload'
         pkgs = ['apache2',]
         return (pre, pkgs, post)
 
@@ -0,0 +1,92 @@
+# encoding: UTF-8
+"""Build instrumentation.
+
+Each process keeps a `BuildStats` in `otto.instrument.stats`, and the build
+code reports into it: time spent in each phase (`timer`), counters (`count`)
+and how long each input file took (`file_time`). Worker processes send their
+numbers back to the parent with `take`, which the parent `merge`s.
+
+Phase times are summed over all processes, so in a parallel build they add
+up to more than the elapsed time.
+"""
+import collections
+import contextlib
+import heapq
+import time
+
+
+class BuildStats(object):
+    """Timings and counters collected during a build."""
+
+    # How many of the slowest files to keep
+    SLOWEST = 20
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.phases = collections.defaultdict(float)
+        self.counters = collections.defaultdict(int)
+        self.files = [] # heap of (seconds, filename), fastest first
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Context manager adding the time spent in its block to `phase`."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[phase] += time.time() - start
+
+    def count(self, counter, n=1):
+        self.counters[counter] += n
+
+    def file_time(self, filename, seconds):
+        """Record the time taken to build `filename`, keeping only the slowest."""
+        if len(self.files) < self.SLOWEST:
+            heapq.heappush(self.files, (seconds, filename))
+        else:
+            heapq.heappushpop(self.files, (seconds, filename))
+
+    def as_dict(self):
+        return {
+            'phases': dict(self.phases),
+            'counters': dict(self.counters),
+            'slowest': [ {'file': f, 'seconds': s} for s, f in sorted(self.files, reverse=True) ],
+            }
+
+    def take(self):
+        """Return the numbers collected so far as a dict, and start over."""
+        data = self.as_dict()
+        self.reset()
+        return data
+
+    def merge(self, data):
+        """Add the numbers from a dict returned by `take` (e.g. from a worker)."""
+        for phase, seconds in data['phases'].iteritems():
+            self.phases[phase] += seconds
+        for counter, n in data['counters'].iteritems():
+            self.counters[counter] += n
+        for item in data['slowest']:
+            self.file_time(item['file'], item['seconds'])
+
+    def summary(self, elapsed=None):
+        """Return a human readable report, as a string."""
+        lines = []
+        if elapsed is not None:
+            lines.append("Build took %.3fs" % elapsed)
+        lines.append("Phases:")
+        for phase, seconds in sorted(self.phases.items(), key=lambda i: i[1], reverse=True):
+            lines.append("  %-20s %10.3fs" % (phase, seconds))
+        lines.append("Counters:")
+        for counter, n in sorted(self.counters.items()):
+            lines.append("  %-20s %10d" % (counter, n))
+        if self.files:
+            lines.append("Slowest files:")
+            for seconds, filename in sorted(self.files, reverse=True)[:10]:
+                lines.append("  %10.3fs %s" % (seconds, filename))
+        return '\n'.join(lines)
+
+
+# The stats of the build in progress, in this process
+stats = BuildStats()
@@ -0,0 +1,215 @@
+# encoding: UTF-8
+"""Markdown conversion for otto.blog.
+
+Creating a Markdown converter loads all of its extensions, and with them the
+Pygments lexers used by 'codehilite'. Each process therefore keeps a single
+converter and resets it between documents.
+
+The metadata header of a document can be read on its own with `read_meta`,
+which is much cheaper than converting the document.
+
+Converted documents are also cached on disk under `env['otto.cache_dir']`,
+keyed by a hash of the source text and the converter configuration, so that
+unchanged documents are never converted twice. The cache is safe to share
+between processes, and safe to delete at any time. Set
+`env['otto.blog.markdown_cache']` to False to disable it.
+
+Code blocks highlighted by 'codehilite' are cached the same way, keyed by a
+hash of the code, its language and the highlighting options, so the same
+snippet is only ever highlighted once, even when it appears in several
+documents or a document changes around it, and lexers are looked up by name
+once per process. This only applies while `convert` runs, other Markdown
+converters in the process are left alone. Set
+`env['otto.blog.highlight_cache']` to False to disable it.
+"""
+from contextlib import contextmanager
+import hashlib
+import os
+import os.path
+
+from fabric.api import env
+import markdown
+from markdown.extensions import codehilite, fenced_code
+try:
+    import pygments
+    import pygments.lexers
+    from pygments.util import ClassNotFound
+except ImportError:
+    pygments = None
+
+from otto.instrument import stats
+from otto.util import dump, json_load, paths, slurp
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+EXTENSIONS = ['codehilite', 'extra', 'meta']
+OUTPUT_FORMAT = 'html4'
+
+
+# Module cache, only init the converter once per process
+converter = None
+def get_converter():
+    global converter
+    if converter == None:
+        converter = markdown.Markdown(
+                extensions=EXTENSIONS,
+                output_format=OUTPUT_FORMAT,
+                )
+    return converter
+
+
+def config_key():
+    """A string identifying everything besides the source text that affects conversion."""
+    return repr(( EXTENSIONS, OUTPUT_FORMAT,
+        getattr(markdown, '__version__', None) or markdown.version,
+        pygments and pygments.__version__ ))
+
+
+def cache_key(text):
+    """Return the cache key for converting `text` with the current configuration."""
+    sha = hashlib.sha1(config_key())
+    sha.update(text.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def cache_filename(key):
+    return paths.cache_dir('markdown', key[:2], key + '.json')
+
+
+def convert(text):
+    """Convert Markdown `text`. Returns a tuple of (html, metadata).
+
+    As with the 'meta' extension, metadata is a dict mapping each (lowercase)
+    key to a list of values.
+    """
+    key = None
+    if env['otto.blog.markdown_cache']:
+        key = cache_key(text)
+        cached = _cache_load(key)
+        if cached:
+            stats.count('markdown_cache_hits')
+            return cached['html'], cached['meta']
+
+    md = get_converter()
+    md.reset()
+    with highlight_cache(env['otto.blog.highlight_cache']):
+        html = md.convert(text)
+    meta = dict(md.Meta)
+    md.reset()
+
+    if key:
+        _cache_save(key, {'html': html, 'meta': meta})
+    return html, meta
+
+
+# Module cache of lexers by name and options, None for unknown names
+lexers = {}
+def get_lexer_by_name(name, **options):
+    """Memoized `pygments.lexers.get_lexer_by_name`."""
+    key = (name, tuple(sorted(options.items())))
+    if key not in lexers:
+        try:
+            lexers[key] = pygments.lexers.get_lexer_by_name(name, **options)
+        except ClassNotFound:
+            lexers[key] = None
+    if lexers[key] is None:
+        raise ClassNotFound('no lexer for alias %r found' % name)
+    return lexers[key]
+
+
+class CachedCodeHilite(codehilite.CodeHilite):
+    """CodeHilite that keeps the code blocks it highlights in the highlight cache."""
+
+    def cache_key(self):
+        sha = hashlib.sha1(repr(( pygments.__version__, self.lang, self.linenums,
+            self.guess_lang, self.css_class, self.style, self.noclasses, self.hl_lines )))
+        sha.update(self.src.encode('utf-8'))
+        return sha.hexdigest()
+
+    def hilite(self):
+        if not (codehilite.pygments and self.use_pygments):
+            return super(CachedCodeHilite, self).hilite()
+        # As the parent does, before the language and options are final
+        self.src = self.src.strip('\n')
+        if self.lang is None:
+            self._parseHeader()
+        key = self.cache_key()
+        filename = paths.cache_dir('highlight', key[:2], key + '.html')
+        if os.path.exists(filename):
+            stats.count('highlight_cache_hits')
+            return slurp(filename)
+        html = super(CachedCodeHilite, self).hilite()
+        _cache_write(html, filename)
+        return html
+
+
+@contextmanager
+def highlight_cache(enabled=True):
+    """Have 'codehilite' (and 'fenced_code', which uses it) highlight with
+    `CachedCodeHilite` and memoized lexers within the block, if `enabled`."""
+    if not enabled:
+        yield
+        return
+    saved = codehilite.CodeHilite, fenced_code.CodeHilite
+    codehilite.CodeHilite = fenced_code.CodeHilite = CachedCodeHilite
+    if pygments:
+        saved_lexer, codehilite.get_lexer_by_name = codehilite.get_lexer_by_name, get_lexer_by_name
+    try:
+        yield
+    finally:
+        codehilite.CodeHilite, fenced_code.CodeHilite = saved
+        if pygments:
+            codehilite.get_lexer_by_name = saved_lexer
+
+
+# Preprocessors of the converter that make the metadata, in order
+META_PREPROCESSORS = ['normalize_whitespace', 'meta']
+
+def read_meta(filename):
+    """Return the metadata of the Markdown file `filename`, as `convert` would.
+
+    Only the header of the file is read, up to the first blank line, and only
+    the preprocessors that parse it are run.
+    """
+    lines = []
+    with open(filename, 'rb') as f:
+        for line in f:
+            lines.append(line.decode('utf-8').rstrip(u'\n'))
+            if not lines[-1].strip():
+                break
+    if not u''.join(lines).strip():
+        return {}
+    # The 'meta' preprocessor replaces md.Meta, no need to reset the converter
+    md = get_converter()
+    for name in META_PREPROCESSORS:
+        if name in md.preprocessors:
+            lines = md.preprocessors[name].run(lines)
+    return dict(md.Meta)
+
+
+def _cache_load(key):
+    filename = cache_filename(key)
+    if not os.path.exists(filename):
+        return None
+    try:
+        return json_load(filename)
+    except ValueError: # corrupt, will be overwritten
+        return None
+
+
+def _cache_save(key, value):
+    _cache_write(json.dumps(value, ensure_ascii=False), cache_filename(key))
+
+
+def _cache_write(text, filename):
+    """Write a cache file. `dump` writes it atomically, so a process reading
+    the cache never sees a partial file."""
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError: # another process made it
+            pass
+    dump(text, filename)
@@ -0,0 +1,333 @@
+# encoding: UTF-8
+"""Static search index for otto.blog.
+
+Set `env['otto.blog.search_dir']` (relative to the blog, e.g. 'search') and
+`build_blog` writes an inverted index of every entry's title, summary and
+content there, as static JSON files. A browser looks up a query by fetching
+only the shards holding its terms, and the documents of the results, so even
+a big site can be searched without a search server. `search.js`, rendered
+from the template of the same name, does just that.
+
+The search dir holds:
+
+`meta.json`
+    Index parameters, e.g. `{"version": 2, "prefix": 2, "split": ["co"],
+    "blocks": {"code": 3}, "ids_per_block": 2000, "docs_per_shard": 100}`.
+
+`t/<shard>.json`
+    Postings of the terms starting with the same `prefix` characters, as
+    `{term: [id, weight, id, weight, ...]}`, ids in ascending order. Shards
+    are named after the prefix if it is plain ASCII letters and digits, and
+    after the hex of its UTF-8 bytes, with a leading '_', otherwise.
+
+    A shard is kept under `POSTINGS_PER_SHARD` postings. Past that, its terms
+    longer than the prefix move to shards of one more character, and the
+    prefix is listed in `split`. A shard left with a single term past the
+    limit is written in `blocks` of `ids_per_block` ids instead, as
+    `t/<shard>-<k>.json` for ids `k * ids_per_block` onwards, and is split
+    too. Shards are never merged back.
+
+`d/<n>.json`
+    Documents `n * docs_per_shard` up to `(n + 1) * docs_per_shard - 1`, as a
+    list of `[path, title, summary]`, null for unused ids.
+
+Terms are words of 2 characters or more, lower case, minus a few stop words.
+A term's weight in a document is the number of times it appears in the
+content, plus 2 per appearance in the summary and 5 in the title.
+
+The index is updated incrementally. The terms and shards of each document
+are kept under `env['otto.cache_dir']`, so when entries change, only the
+shards (or blocks) their old and new terms live in are rewritten.
+"""
+from HTMLParser import HTMLParser
+import json
+import logging
+import os
+import os.path
+import re
+import shutil
+
+from otto.util import dump_iter, json_dump, json_load
+
+VERSION = 2
+PREFIX = 2
+POSTINGS_PER_SHARD = 2000
+DOCS_PER_SHARD = 100
+
+STOP_WORDS = frozenset('''a an and are as at be but by for from has have if in
+    into is it its of on or that the their then there these they this to was
+    were will with'''.split())
+
+TITLE_WEIGHT = 5
+SUMMARY_WEIGHT = 2
+
+WORD = re.compile(r'\w+', re.UNICODE)
+TAG = re.compile(r'<[^>]*>')
+SHARD_NAME = re.compile(r'^[a-z0-9]+$')
+
+
+def tokenize(text):
+    """Return the terms in `text`, in order, repeats included."""
+    return [ word for word in WORD.findall(text.lower())
+        if len(word) > 1 and word not in STOP_WORDS ]
+
+
+def html_text(html):
+    return HTMLParser().unescape(TAG.sub(' ', html))
+
+
+def document(entry, path):
+    """Return the document for `entry`, found at `path`, and its terms.
+
+    The document is the `[path, title, summary]` shown in search results.
+    Terms are a dict of term to weight.
+    """
+    title = html_text(entry.get('title', ''))
+    summary = html_text(entry.get('summary', ''))
+    terms = {}
+    for weight, text in ((TITLE_WEIGHT, title), (SUMMARY_WEIGHT, summary),
+            (1, html_text(entry.bodycontent()) if 'content' in entry else '')):
+        for term in tokenize(text):
+            terms[term] = terms.get(term, 0) + weight
+    return [path, title, summary], terms
+
+
+def shard_prefix(term, split=()):
+    """The prefix of the shard holding `term`: `PREFIX` characters, plus one
+    for each of the `split` prefixes it starts with."""
+    n = PREFIX
+    while n < len(term) and term[:n] in split:
+        n += 1
+    return term[:n]
+
+
+def prefix_name(prefix):
+    if SHARD_NAME.match(prefix):
+        return prefix
+    return '_' + prefix.encode('utf-8').encode('hex')
+
+
+def shard_name(term, split=()):
+    return prefix_name(shard_prefix(term, split))
+
+
+def flatten(pairs):
+    return [ x for pair in sorted(pairs) for x in pair ]
+
+
+class SearchIndex(object):
+    """The search index in `search_dir`, and the state it was built from.
+
+    Call `add` for each entry, then `save` to write the shards that changed.
+    The state (each document's id and shard prefixes, and how shards were
+    split) is kept in `state_file`. If it is missing or does not match the
+    search dir, the index is built again from scratch.
+    """
+
+    def __init__(self, search_dir, state_file):
+        self.search_dir = search_dir
+        self.state_file = state_file
+        state = {}
+        if os.path.exists(state_file) and os.path.exists(self.meta_file()):
+            try:
+                state = json_load(state_file)
+            except ValueError:
+                logging.warning("Ignoring corrupt search state " + state_file)
+        self.rebuild = state.get('version') != VERSION or state.get('search_dir') != search_dir
+        self.docs = {} if self.rebuild else state['docs']
+        self.next_id = 0 if self.rebuild else state['next_id']
+        self.split = set() if self.rebuild else set(state['split'])
+        self.blocks = {} if self.rebuild else state['blocks']
+        self.seen = set()
+        self.changed = {}
+
+    def meta_file(self):
+        return os.path.join(self.search_dir, 'meta.json')
+
+    def needs(self, key):
+        """True if the document `key` must be given to `add` with its terms."""
+        return self.rebuild or key not in self.docs
+
+    def add(self, key, doc=None, terms=None):
+        """Note the document `key` (e.g. the entry input) is in the index.
+
+        Give its `doc` and `terms` (see `document`) if it is new or changed.
+        Otherwise it is kept as it was.
+        """
+        self.seen.add(key)
+        if doc is not None:
+            self.changed[key] = (doc, terms)
+
+    def save(self, prune=True):
+        """Write the changes to the search dir.
+
+        With `prune`, documents that were not added since the last save are
+        removed from the index.
+        """
+        removed = set(self.docs) - self.seen if prune else set()
+        if not self.changed and not removed and not self.rebuild:
+            return
+        if self.rebuild and os.path.isdir(self.search_dir):
+            shutil.rmtree(self.search_dir)
+
+        # The ids of changed and removed documents are cleared from their
+        # old shards, then changed documents are added to their new ones.
+        stale = {}
+        stale_ids = set()
+        for key in removed | set(self.changed):
+            if key in self.docs:
+                doc_id, prefixes = self.docs[key]
+                stale_ids.add(doc_id)
+                for prefix in prefixes.split():
+                    stale.setdefault(prefix, set()).add(doc_id)
+        for key in removed:
+            del self.docs[key]
+
+        postings = {}
+        doc_shards = {}
+        for key, (doc, terms) in sorted(self.changed.items()):
+            if key in self.docs:
+                doc_id = self.docs[key][0]
+            else:
+                doc_id = self.next_id
+                self.next_id += 1
+            prefixes = set()
+            for term, weight in terms.iteritems():
+                prefix = shard_prefix(term, self.split)
+                prefixes.add(prefix)
+                postings.setdefault(prefix, {}).setdefault(term, []).append( (doc_id, weight) )
+            self.docs[key] = [doc_id, ' '.join(sorted(prefixes))]
+            doc_shards.setdefault(doc_id // DOCS_PER_SHARD, {})[doc_id] = doc
+        for doc_id in stale_ids:
+            doc_shards.setdefault(doc_id // DOCS_PER_SHARD, {}).setdefault(doc_id, None)
+
+        self._keys = None
+        self._prefixes = {}
+        for prefix in sorted(set(stale) | set(postings)):
+            self._save_terms(prefix, stale.get(prefix, set()), postings.get(prefix, {}))
+        for doc_id, prefixes in self._prefixes.iteritems():
+            self.docs[self._keys[doc_id]][1] = ' '.join(sorted(prefixes))
+        for n, docs in doc_shards.iteritems():
+            self._save_docs(n, docs)
+        self._save(self.meta_file(), {'version': VERSION, 'prefix': PREFIX,
+            'split': sorted(self.split), 'blocks': self.blocks,
+            'ids_per_block': POSTINGS_PER_SHARD, 'docs_per_shard': DOCS_PER_SHARD})
+        self._save_script()
+
+        if not os.path.isdir(os.path.dirname(self.state_file)):
+            os.makedirs(os.path.dirname(self.state_file))
+        json_dump({'version': VERSION, 'search_dir': self.search_dir, 'docs': self.docs,
+            'next_id': self.next_id, 'split': sorted(self.split), 'blocks': self.blocks},
+            self.state_file)
+        self.rebuild = False
+        self.changed = {}
+
+    def _load(self, filename, default):
+        if not os.path.exists(filename):
+            return default
+        return json_load(filename)
+
+    def _save(self, filename, data):
+        if data:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            json_dump(data, filename)
+        elif os.path.exists(filename):
+            os.remove(filename)
+
+    def _terms_file(self, prefix, block=None):
+        name = prefix_name(prefix) if block is None else '%s-%d' % (prefix_name(prefix), block)
+        return os.path.join(self.search_dir, 't', name + '.json')
+
+    def _load_terms(self, filename, stale_ids):
+        """Load a terms shard as `{term: [(id, weight), ...]}`, without `stale_ids`."""
+        terms = {}
+        for term, flat in self._load(filename, {}).iteritems():
+            pairs = [ (flat[i], flat[i + 1]) for i in range(0, len(flat), 2)
+                if flat[i] not in stale_ids ]
+            if pairs:
+                terms[term] = pairs
+        return terms
+
+    def _save_terms(self, prefix, stale_ids, postings):
+        """Rewrite the terms shard of `prefix` without `stale_ids`, plus
+        `postings`. Of a shard in blocks, only the blocks of those ids."""
+        if prefix in self.blocks:
+            for block in sorted(set( i // POSTINGS_PER_SHARD for i in stale_ids ) |
+                    set( i // POSTINGS_PER_SHARD for pairs in postings.itervalues()
+                        for i, weight in pairs )):
+                filename = self._terms_file(prefix, block)
+                terms = self._load_terms(filename, stale_ids)
+                for term, pairs in postings.iteritems():
+                    terms.setdefault(term, []).extend( (i, w) for i, w in pairs
+                        if i // POSTINGS_PER_SHARD == block )
+                self._save(filename, dict( (term, flatten(pairs))
+                    for term, pairs in terms.iteritems() if pairs ))
+                self.blocks[prefix] = max(self.blocks[prefix], block + 1)
+            return
+        terms = self._load_terms(self._terms_file(prefix), stale_ids)
+        for term, pairs in postings.iteritems():
+            terms.setdefault(term, []).extend(pairs)
+        self._write_terms(prefix, terms)
+
+    def _write_terms(self, prefix, terms):
+        """Write `terms` as the shard of `prefix`, split if it is too big."""
+        if sum( len(pairs) for pairs in terms.itervalues() ) > POSTINGS_PER_SHARD:
+            longer = [ term for term in terms if len(term) > len(prefix) ]
+            if longer:
+                self.split.add(prefix)
+                children = {}
+                for term in longer:
+                    children.setdefault(term[:len(prefix) + 1], {})[term] = terms.pop(term)
+                self._moved(prefix, terms, children)
+                for child in sorted(children):
+                    self._write_terms(child, children[child])
+        if sum( len(pairs) for pairs in terms.itervalues() ) > POSTINGS_PER_SHARD:
+            # A single term, too common to fit. Longer terms go to other shards.
+            self.split.add(prefix)
+            (term, pairs), = terms.items()
+            blocks = {}
+            for doc_id, weight in pairs:
+                blocks.setdefault(doc_id // POSTINGS_PER_SHARD, []).append( (doc_id, weight) )
+            for block, block_pairs in blocks.iteritems():
+                self._save(self._terms_file(prefix, block), {term: flatten(block_pairs)})
+            self.blocks[prefix] = max(blocks) + 1
+            terms = {}
+        self._save(self._terms_file(prefix), dict( (term, flatten(pairs))
+            for term, pairs in terms.iteritems() ))
+
+    def _moved(self, prefix, terms, children):
+        """Note the documents whose terms of `prefix` moved to the shards of
+        `children`, leaving `terms`. Their prefixes are updated at the end of
+        `save`."""
+        if self._keys is None:
+            self._keys = dict( (doc_id, key) for key, (doc_id, p) in self.docs.iteritems() )
+        staying = set( i for pairs in terms.itervalues() for i, weight in pairs )
+        for child, child_terms in children.iteritems():
+            for pairs in child_terms.itervalues():
+                for doc_id, weight in pairs:
+                    prefixes = self._prefixes.get(doc_id)
+                    if prefixes is None:
+                        prefixes = self._prefixes[doc_id] = \
+                            set(self.docs[self._keys[doc_id]][1].split())
+                    prefixes.add(child)
+                    if doc_id not in staying:
+                        prefixes.discard(prefix)
+
+    def _save_docs(self, n, docs):
+        """Rewrite a documents shard with `docs`, a dict of id to document or None."""
+        filename = os.path.join(self.search_dir, 'd', '%d.json' % n)
+        shard = self._load(filename, [])
+        shard.extend([None] * (DOCS_PER_SHARD - len(shard)))
+        for doc_id, doc in docs.iteritems():
+            shard[doc_id - n * DOCS_PER_SHARD] = doc
+        while shard and shard[-1] is None:
+            shard.pop()
+        self._save(filename, shard)
+
+    def _save_script(self):
+        from otto.blog import get_jinja # otto.blog imports this module
+        template = get_jinja().get_template('search.js')
+        # Serialized here, as the tojson filter needs a newer Jinja2
+        dump_iter(template.generate(stop_words=json.dumps(sorted(STOP_WORDS))),
+            os.path.join(self.search_dir, 'search.js'))
@@ -0,0 +1,177 @@
+# encoding: UTF-8
+"""Sitemaps for otto.blog.
+
+Set `env['otto.blog.sitemap']` (relative to the blog, e.g. 'sitemap.xml') and
+`build_blog` lists the URL of every entry, channel index and tag index in
+sitemaps, for search engines to crawl. The file named is a sitemap index,
+pointing to the sitemaps proper next to it, `sitemap-0.xml`, `sitemap-1.xml`
+and so on, each listing at most 50,000 URLs, the limit of the sitemap
+protocol. The `lastmod` of an entry is its sort date, that of an index the
+sort date of its newest entry.
+
+Sitemaps are written as they are generated, never held in memory whole. The
+URLs and the sitemap each is listed in are kept under `env['otto.cache_dir']`,
+so when entries change, only the sitemaps listing them are rewritten. A URL
+keeps its sitemap for as long as it exists; new URLs fill the first sitemap
+with room.
+"""
+from datetime import datetime
+from dateutil import tz
+import logging
+import os
+import os.path
+import re
+from xml.sax.saxutils import escape
+
+from otto.util import dump_iter, json_dump, json_load
+
+VERSION = 1
+URLS_PER_SITEMAP = 50000
+
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+
+
+def w3c_datetime(value):
+    """Format a datetime in UTC, as sitemaps want, or None if there is none."""
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo:
+        value = value.astimezone(tz.tzutc())
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class Sitemap(object):
+    """The sitemaps of `filename`, the sitemap index at `url`, and the state
+    they were written from.
+
+    Call `add` for each page, then `save` to write the sitemaps that changed.
+    The state (each page's URL, lastmod and sitemap number) is kept in
+    `state_file`. If it is missing or does not match the sitemap index, the
+    sitemaps are written again from scratch.
+    """
+
+    def __init__(self, filename, url, state_file):
+        self.filename = filename
+        self.url = url
+        self.state_file = state_file
+        state = {}
+        if os.path.exists(state_file) and os.path.exists(filename):
+            try:
+                state = json_load(state_file)
+            except ValueError:
+                logging.warning("Ignoring corrupt sitemap state " + state_file)
+        self.rebuild = state.get('version') != VERSION or state.get('filename') != filename
+        self.pages = {} if self.rebuild else state['pages']
+        self.sitemaps = 0 if self.rebuild else state['sitemaps']
+        self.seen = set()
+        self.changed = {}
+
+    def sitemap_file(self, n):
+        stem, ext = os.path.splitext(self.filename)
+        return '%s-%d%s' % (stem, n, ext)
+
+    def add(self, key, url, lastmod=None):
+        """Note the page `key` (e.g. the entry input) is at `url`, last
+        modified at `lastmod`, a datetime."""
+        self.seen.add(key)
+        page = [url, w3c_datetime(lastmod)]
+        if self.pages.get(key, [None, None])[:2] != page:
+            self.changed[key] = page
+
+    def remove(self, key):
+        """Note the page `key` is gone, even if `save` does not prune."""
+        self.seen.discard(key)
+        self.changed[key] = None
+
+    def save(self, prune=True):
+        """Write the changes to the sitemaps.
+
+        With `prune`, pages that were not added since the last save are
+        removed from the sitemaps.
+        """
+        removed = set(self.pages) - self.seen if prune else set()
+        removed.update( key for key, page in self.changed.items() if page is None )
+        if not self.changed and not removed and not self.rebuild:
+            return
+        if not os.path.isdir(os.path.dirname(self.filename)):
+            os.makedirs(os.path.dirname(self.filename))
+        if self.rebuild:
+            # Sitemaps left by a build we know nothing about
+            stem, ext = os.path.splitext(os.path.basename(self.filename))
+            stale = re.compile(r'^%s-\d+%s$' % (re.escape(stem), re.escape(ext)))
+            for name in os.listdir(os.path.dirname(self.filename)):
+                if stale.match(name):
+                    os.remove(os.path.join(os.path.dirname(self.filename), name))
+
+        dirty = set()
+        counts = [0] * self.sitemaps
+        for key, page in self.pages.iteritems():
+            counts[page[2]] += 1
+        for key in removed:
+            if key in self.pages:
+                n = self.pages.pop(key)[2]
+                counts[n] -= 1
+                dirty.add(n)
+        free = 0
+        for key, page in sorted(self.changed.items()):
+            if page is None:
+                continue
+            if key in self.pages:
+                n = self.pages[key][2]
+            else:
+                while free < len(counts) and counts[free] >= URLS_PER_SITEMAP:
+                    free += 1
+                if free == len(counts):
+                    counts.append(0)
+                n = free
+                counts[n] += 1
+            self.pages[key] = page + [n]
+            dirty.add(n)
+        while counts and not counts[-1]:
+            counts.pop()
+
+        by_sitemap = [ [] for n in counts ]
+        for key, page in self.pages.iteritems():
+            if page[2] in dirty:
+                by_sitemap[page[2]].append(page)
+        for n in sorted(dirty):
+            if n < len(counts):
+                self._save_sitemap(n, by_sitemap[n])
+        for n in range(len(counts), self.sitemaps):
+            if os.path.exists(self.sitemap_file(n)):
+                os.remove(self.sitemap_file(n))
+        self.sitemaps = len(counts)
+        self._save_index()
+
+        if not os.path.isdir(os.path.dirname(self.state_file)):
+            os.makedirs(os.path.dirname(self.state_file))
+        json_dump({'version': VERSION, 'filename': self.filename, 'pages': self.pages,
+            'sitemaps': self.sitemaps}, self.state_file)
+        self.rebuild = False
+        self.changed = {}
+
+    def _save_sitemap(self, n, pages):
+        """Write sitemap `n`, listing `pages`, in URL order."""
+        def chunks():
+            yield u'<?xml version="1.0" encoding="UTF-8"?>\n<urlset xmlns="%s">\n' % SITEMAP_NS
+            for url, lastmod, n in sorted(pages):
+                yield u'<url><loc>%s</loc>%s</url>\n' % (escape(url),
+                    u'<lastmod>%s</lastmod>' % lastmod if lastmod else u'')
+            yield u'</urlset>\n'
+        dump_iter(chunks(), self.sitemap_file(n))
+
+    def _save_index(self):
+        """Write the sitemap index, with the newest lastmod of each sitemap."""
+        lastmods = [None] * self.sitemaps
+        for url, lastmod, n in self.pages.itervalues():
+            lastmods[n] = max(lastmods[n], lastmod)
+        base = self.url[:self.url.rfind('/') + 1]
+        def chunks():
+            yield u'<?xml version="1.0" encoding="UTF-8"?>\n<sitemapindex xmlns="%s">\n' % \
+                SITEMAP_NS
+            for n, lastmod in enumerate(lastmods):
+                yield u'<sitemap><loc>%s</loc>%s</sitemap>\n' % (
+                    escape(base + os.path.basename(self.sitemap_file(n))),
+                    u'<lastmod>%s</lastmod>' % lastmod if lastmod else u'')
+            yield u'</sitemapindex>\n'
+        dump_iter(chunks(), self.filename)
@@ -0,0 +1,441 @@
+# encoding: UTF-8
+"""Post-build stages that prepare a build for static serving.
+
+Otto sites are static files served by Apache or nginx. The tasks here work
+on a finished build, after `build` and `build_blog` are done, in this order:
+
+`fingerprint_assets`
+    Gives each static asset (CSS, JavaScript, images, fonts) a copy named
+    after its content, e.g. `css/site.3f2a9c0d1e.css` for `css/site.css`,
+    and points the references to assets in HTML and Atom files to those
+    copies. As a copy never changes, browsers can cache it forever, and never
+    have to ask the server whether it did. The originals stay in place, for
+    references that are not rewritten (such as `url()` in CSS, or links from
+    other sites).
+
+    The copies are listed in a manifest, `env['otto.static.asset_manifest']`
+    in the build dir, mapping the path of each asset (relative to the web
+    root) to the path of its copy. Pages are only rewritten if they changed
+    since the last run, or if the manifest did. The web server configuration
+    that marks the copies as cacheable forever is written to the build's
+    `etc/`, from where `otto.web.deploy` installs it: for Apache,
+    `etc/apache2/conf.d/<site>-assets.conf` (needs mod_headers), for nginx,
+    `etc/nginx/snippets/<site>-assets.conf`, to `include` in the `server`
+    block of the site.
+
+`precompress`
+    Writes a gzip compressed copy of each HTML, Atom, JSON, CSS, JavaScript
+    and similar file next to it, as `<name>.gz`, and a Brotli compressed copy
+    as `<name>.br` if enabled. nginx serves them in place of the original
+    with `gzip_static on` (and `brotli_static on`), Apache with MultiViews
+    and `AddEncoding gzip .gz`, so the server does not compress the same
+    bytes on every request.
+
+    The compressed copies are minified: HTML, Atom and XML lose the
+    indentation between tags (except in `pre`, `textarea`, `script` and
+    `style` elements and CDATA sections), and JSON its optional whitespace.
+    The original files are left as rendered, so that incremental builds
+    still find them unchanged. A file is only compressed again if it is
+    newer than its compressed copy. Compressed copies of files that were
+    removed are removed too. Files are compressed in a pool of worker
+    processes.
+
+Set the following keys in your `env` to configure otto.static:
+
+`otto.static.fingerprint`
+    *Optional.* Default=['*.css', '*.js', '*.png', '*.jpg', '*.jpeg', '*.gif',
+    '*.svg', '*.ico', '*.webp', '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot'].
+    Patterns of the assets to fingerprint.
+
+`otto.static.rewrite`
+    *Optional.* Default=['*.html', '*.htm', '*.atom']. Patterns of the files
+    whose references to assets are rewritten.
+
+`otto.static.asset_manifest`
+    *Optional.* Default="assets.json". Where the asset manifest is written,
+    relative to the build dir.
+
+`otto.static.compress`
+    *Optional.* Default=['*.html', '*.atom', '*.json', '*.css', '*.js',
+    '*.svg', '*.xml', '*.txt']. Patterns of the files to compress.
+
+`otto.static.minify`
+    *Optional.* Default=True. Set to False to compress files as they are.
+
+`otto.static.brotli`
+    *Optional.* Default=False. Set to True to also write `.br` files. Needs
+    the `brotli` module.
+
+`otto.static.workers`
+    *Optional.* Default=0. The number of processes to compress with (0 for
+    one per CPU).
+
+"""
+import collections
+import fnmatch
+import gzip
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import posixpath
+import re
+import tempfile
+import urllib
+import urlparse
+
+from fabric.api import env, require, task
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from otto.util import copy_file, digest, dump, json_dump, json_load, paths, slurp
+
+DEFAULT_CONFIG = {
+    'otto.static.fingerprint': ['*.css', '*.js', '*.png', '*.jpg', '*.jpeg', '*.gif',
+        '*.svg', '*.ico', '*.webp', '*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot'],
+    'otto.static.rewrite': ['*.html', '*.htm', '*.atom'],
+    'otto.static.asset_manifest': 'assets.json', # relative to the build dir
+    'otto.static.compress': ['*.html', '*.atom', '*.json', '*.css', '*.js', '*.svg',
+        '*.xml', '*.txt'],
+    'otto.static.minify': True,
+    'otto.static.brotli': False,
+    'otto.static.workers': 0, # 0 means one per CPU
+    }
+for k, v in DEFAULT_CONFIG.iteritems():
+    env.setdefault(k, v)
+
+COMPRESSED_EXTENSIONS = ['.gz', '.br']
+
+
+def matches(name, patterns):
+    return any(fnmatch.fnmatch(name, p) for p in patterns)
+
+
+def cache_filename(dest_dir, suffix):
+    """Location of a cache file for the stages run on `dest_dir`."""
+    name = re.sub(r'\W+', '_', dest_dir).strip('_')
+    return paths.cache_dir('static', (name or 'root') + suffix)
+
+
+#######################################################################
+# Fingerprinting
+#######################################################################
+FINGERPRINT_LENGTH = 10
+FINGERPRINT = re.compile(r'^(.+)\.[0-9a-f]{%d}(\.[^.]+)$' % FINGERPRINT_LENGTH)
+
+def fingerprinted_name(name, sha1):
+    """`name` with the start of the digest of its content inserted before the extension."""
+    stem, ext = os.path.splitext(name)
+    return '%s.%s%s' % (stem, sha1[:FINGERPRINT_LENGTH], ext)
+
+
+def fingerprint_files(root, patterns, previous, state):
+    """Make a content-hashed copy of each asset under `root` matching `patterns`.
+
+    Returns the manifest, a dict of asset path to copy path, both relative to
+    `root` with '/' separators. `previous` is the manifest of the last run.
+    Copies it lists that are no longer current are removed. `state` is a
+    dict of asset path to its size, mtime and SHA-1 digest at the last run,
+    updated in place, so that unchanged assets are not hashed again.
+    """
+    copies = set(previous.values())
+    manifest = {}
+    for thisdir, subdirs, files in os.walk(unicode(root)):
+        names = set(files)
+        for name in files:
+            if name.startswith('.') or not matches(name, patterns):
+                continue
+            filename = os.path.join(thisdir, name)
+            relpath = os.path.relpath(filename, root).replace(os.sep, '/')
+            fingerprinted = FINGERPRINT.match(name)
+            if relpath in copies or (fingerprinted and ''.join(fingerprinted.groups()) in names):
+                continue # a copy
+            stat = os.stat(filename)
+            known = state.get(relpath)
+            if known and known[0] == stat.st_size and known[1] == stat.st_mtime:
+                sha1 = known[2]
+            else:
+                sha1 = digest(filename)
+            state[relpath] = [stat.st_size, stat.st_mtime, sha1]
+            manifest[relpath] = posixpath.join(posixpath.dirname(relpath),
+                fingerprinted_name(name, sha1))
+            copy = os.path.join(thisdir, fingerprinted_name(name, sha1))
+            if not os.path.exists(copy):
+                copy_file(filename, copy, 'hardlink')
+
+    for relpath in copies.difference(manifest.values()):
+        copy = os.path.join(root, *relpath.split('/'))
+        if os.path.exists(copy):
+            logging.info("Removing " + copy)
+            os.remove(copy)
+    for relpath in set(state).difference(manifest):
+        del state[relpath]
+    return manifest
+
+
+# The start of an attribute or CSS url() (in markup, or escaped in an Atom
+# feed), then the path part of the URL
+REFERENCE = re.compile(r'''(\b(?:src|href|poster)\s*=\s*(?:"|'|&quot;|&#39;)|\burl\(\s*(?:"|'|&quot;|&#39;)?)([^"'<>()\s&?#]+)''',
+    re.IGNORECASE)
+
+def rewrite_references(text, docpath, lookup):
+    """Point the references to assets in HTML or Atom `text` to their copies.
+
+    `docpath` is the path of the document, relative to the web root, that
+    relative URLs are resolved against. `lookup` maps asset paths to copy
+    paths, like a manifest. Only the file name in each URL changes, as the
+    copies sit next to the assets.
+    """
+    site = env.get('otto.site', None)
+    def replace(match):
+        prefix, url = match.groups()
+        parts = urlparse.urlsplit(url)
+        if parts.scheme or parts.netloc:
+            if parts.scheme not in ('', 'http', 'https') or parts.netloc != site:
+                return match.group(0)
+            path = parts.path
+        else:
+            path = posixpath.join('/', posixpath.dirname(docpath), url)
+        hashed = lookup.get(posixpath.normpath(urllib.unquote(path)).lstrip('/'))
+        if not hashed:
+            return match.group(0)
+        name = posixpath.basename(hashed)
+        if '%' in url:
+            name = urllib.quote(name.encode('utf-8')).decode('utf-8')
+        return prefix + url[:url.rfind('/') + 1] + name
+    return REFERENCE.sub(replace, text)
+
+
+def rewrite_files(root, patterns, lookup, state, changed):
+    """Rewrite the references to assets in the files under `root` matching
+    `patterns`, see `rewrite_references`.
+
+    `state` is a dict of file path to size and mtime after the last rewrite,
+    updated in place. Unless the `lookup` `changed`, files with the same size
+    and mtime are skipped. Returns the number of files rewritten.
+    """
+    rewritten = 0
+    seen = set()
+    for thisdir, subdirs, files in os.walk(unicode(root)):
+        for name in files:
+            if name.startswith('.') or not matches(name, patterns):
+                continue
+            filename = os.path.join(thisdir, name)
+            relpath = os.path.relpath(filename, root).replace(os.sep, '/')
+            seen.add(relpath)
+            stat = os.stat(filename)
+            if not changed and state.get(relpath) == [stat.st_size, stat.st_mtime]:
+                continue
+            if dump(rewrite_references(slurp(filename), relpath, lookup), filename):
+                rewritten += 1
+                stat = os.stat(filename)
+            state[relpath] = [stat.st_size, stat.st_mtime]
+    for relpath in set(state).difference(seen):
+        del state[relpath]
+    return rewritten
+
+
+APACHE_ASSETS_CONF = """# Written by otto.static.fingerprint_assets. Files named after their content
+# never change, so they can be cached forever.
+<IfModule mod_headers.c>
+<Directory %(root)s>
+    <FilesMatch "%(pattern)s">
+        Header set Cache-Control "public, max-age=31536000, immutable"
+    </FilesMatch>
+</Directory>
+</IfModule>
+"""
+
+NGINX_ASSETS_CONF = """# Written by otto.static.fingerprint_assets. Files named after their content
+# never change, so they can be cached forever. Include in the server block of
+# the site.
+location ~* "%(pattern)s" {
+    add_header Cache-Control "public, max-age=31536000, immutable";
+}
+"""
+
+def server_config(dest_dir, patterns):
+    """Return the path (under the build's `etc/`) and text of the web server
+    configuration for the copies of assets matching `patterns`, or None if
+    `otto.httpserver` is not one Otto knows."""
+    extensions = [ p[2:] for p in patterns if re.match(r'^\*\.[\w.]+$', p) ]
+    context = {
+        'root': paths.site_dir('current', dest_dir),
+        'pattern': r'\.[0-9a-f]{%d}\.(%s)$' % (FINGERPRINT_LENGTH,
+            '|'.join(re.escape(e) for e in extensions)),
+        }
+    site = env['otto.site']
+    if env['otto.httpserver'] == 'apache2':
+        return os.path.join('etc', 'apache2', 'conf.d', site + '-assets.conf'), \
+            APACHE_ASSETS_CONF % context
+    if env['otto.httpserver'] == 'nginx':
+        return os.path.join('etc', 'nginx', 'snippets', site + '-assets.conf'), \
+            NGINX_ASSETS_CONF % context
+    return None
+
+
+@task
+def fingerprint_assets(dest_dir='htdocs'):
+    """Give static assets content-hashed names, and point pages to them."""
+    require('otto.build_dir', 'otto.site')
+    root = paths.build_dir(dest_dir)
+    manifest_file = paths.build_dir(env['otto.static.asset_manifest'])
+    state_file = cache_filename(dest_dir, '.fingerprint.json')
+    previous = json_load(manifest_file) if os.path.exists(manifest_file) else {}
+    state = {'assets': {}, 'pages': {}}
+    if previous and os.path.exists(state_file):
+        state = json_load(state_file)
+
+    manifest = fingerprint_files(root, env['otto.static.fingerprint'], previous,
+        state['assets'])
+    # Pages rewritten by the last run refer to its copies
+    lookup = dict(manifest)
+    for relpath, copy in previous.iteritems():
+        if relpath in manifest:
+            lookup[copy] = manifest[relpath]
+    rewritten = rewrite_files(root, env['otto.static.rewrite'], lookup, state['pages'],
+        manifest != previous)
+
+    json_dump(manifest, manifest_file)
+    config = server_config(dest_dir, env['otto.static.fingerprint'])
+    if config:
+        filename, text = config
+        filename = paths.build_dir(filename)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        dump(text, filename)
+    else:
+        logging.warning("No cache configuration for %s assets." % env['otto.httpserver'])
+    if not os.path.isdir(os.path.dirname(state_file)):
+        os.makedirs(os.path.dirname(state_file))
+    json_dump(state, state_file)
+    logging.info("Fingerprinted %d asset(s), rewrote %d file(s)" % (len(manifest), rewritten))
+
+
+#######################################################################
+# Minification
+#######################################################################
+MARKUP_EXTENSIONS = ['.html', '.htm', '.atom', '.xml', '.svg']
+
+# Either a block where whitespace matters (or that is not markup), kept as
+# is, or whitespace spanning lines between two tags
+MARKUP_WHITESPACE = re.compile(
+    r'(<!\[CDATA\[.*?\]\]>|<(pre|textarea|script|style)\b.*?</\2\s*>)|(?<=>)\s*\n\s*(?=<)',
+    re.DOTALL | re.IGNORECASE)
+
+def minify_markup(text):
+    """Drop the indentation between the tags of HTML or XML `text`.
+
+    Whitespace between two tags that spans lines becomes a single newline,
+    which HTML renders the same and XML readers ignore.
+    """
+    return MARKUP_WHITESPACE.sub(lambda m: m.group(1) or u'\n', text).strip()
+
+
+def minify_json(text):
+    """Remove the optional whitespace from JSON `text`, keeping the key order."""
+    return json.dumps(json.loads(text, object_pairs_hook=collections.OrderedDict),
+        ensure_ascii=False, separators=(',', ':'))
+
+
+def minify(text, ext):
+    """Minify `text` of the type given by the file extension `ext`, if known."""
+    if ext in MARKUP_EXTENSIONS:
+        return minify_markup(text)
+    if ext == '.json':
+        return minify_json(text)
+    return text
+
+
+#######################################################################
+# Compression
+#######################################################################
+def compressed_formats():
+    """The compressed copies to write, as a list of extensions."""
+    formats = ['.gz']
+    if env['otto.static.brotli']:
+        if brotli:
+            formats.append('.br')
+        else:
+            logging.warning("otto.static.brotli needs the brotli module, skipping .br files.")
+    return formats
+
+
+def compress_jobs(root, patterns, formats):
+    """Return the files under `root` matching `patterns` whose compressed
+    copies are missing or older than them, with the formats they need.
+
+    Compressed copies of files that no longer exist, or in formats no longer
+    wanted, are removed.
+    """
+    jobs = []
+    for thisdir, subdirs, files in os.walk(root):
+        names = set(files)
+        for name in files:
+            stem, ext = os.path.splitext(name)
+            if ext in COMPRESSED_EXTENSIONS:
+                if matches(stem, patterns) and (stem not in names or ext not in formats):
+                    logging.info("Removing " + os.path.join(thisdir, name))
+                    os.remove(os.path.join(thisdir, name))
+                continue
+            if name.startswith('.') or not matches(name, patterns):
+                continue
+            filename = os.path.join(thisdir, name)
+            mtime = os.path.getmtime(filename)
+            stale = [ f for f in formats if name + f not in names or
+                os.path.getmtime(filename + f) < mtime ]
+            if stale:
+                jobs.append( (filename, stale) )
+    return jobs
+
+
+def _compress(job):
+    """Write the compressed copies of a file. Runs in the worker pool."""
+    filename, formats = job
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if env['otto.static.minify']:
+        ext = os.path.splitext(filename)[1].lower()
+        try:
+            data = minify(data.decode('utf-8'), ext).encode('utf-8')
+        except ValueError: # not UTF-8, or not JSON after all
+            logging.warning("Not minifying " + filename)
+    for format in formats:
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                if format == '.gz':
+                    # No name or time in the header, so the same data always
+                    # compresses to the same file
+                    with gzip.GzipFile('', 'wb', 9, f, mtime=0) as gz:
+                        gz.write(data)
+                else:
+                    f.write(brotli.compress(data))
+            os.chmod(tmpname, os.stat(filename).st_mode & 0777)
+            os.rename(tmpname, filename + format)
+        except:
+            os.remove(tmpname)
+            raise
+
+
+@task
+def precompress(dest_dir=''):
+    """Write minified, compressed copies of the text files in the build."""
+    require('otto.build_dir')
+    root = paths.build_dir(dest_dir)
+    jobs = compress_jobs(root, env['otto.static.compress'], compressed_formats())
+    workers = int(env['otto.static.workers']) or multiprocessing.cpu_count()
+    if workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            pool.map(_compress, jobs, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            _compress(job)
+    logging.info("Compressed %d file(s) under %s" % (len(jobs), root))
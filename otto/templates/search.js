@@ -0,0 +1,95 @@
+{# Client for the static search index written by otto.search. #}
+/* Search the static index in the directory of this script.
+ *
+ *   ottoSearch("some words").then(function (results) { ... });
+ *
+ * Results are {path, title, summary, score} for the entries having all the
+ * words, best first. Only the index parameters, the shards holding the
+ * words, and the documents of the top results, are downloaded.
+ */
+var ottoSearch = (function () {
+    var base = document.currentScript.src.replace(/[^\/]*$/, "");
+    var stopWords = {};
+    {{ stop_words|safe }}.forEach(function (w) { stopWords[w] = true; });
+    var cache = {};
+
+    function fetchJSON(path) {
+        if (!cache[path]) {
+            cache[path] = fetch(base + path).then(function (response) {
+                return response.ok ? response.json() : null;
+            });
+        }
+        return cache[path];
+    }
+
+    function tokenize(text) {
+        return (text.toLowerCase().match(/[\p{L}\p{M}\p{N}_]+/gu) || []).filter(function (w) {
+            return w.length > 1 && !stopWords[w];
+        });
+    }
+
+    // The files of the shard holding term, as otto.search splits them
+    function shardFiles(term, meta) {
+        var chars = Array.from(term);
+        var n = meta.prefix;
+        while (n < chars.length && meta.split.indexOf(chars.slice(0, n).join("")) >= 0) {
+            n++;
+        }
+        var p = chars.slice(0, n).join("");
+        var name = p;
+        if (!/^[a-z0-9]+$/.test(p)) {
+            name = "_" + Array.from(new TextEncoder().encode(p)).map(function (b) {
+                return ("0" + b.toString(16)).slice(-2);
+            }).join("");
+        }
+        if (!meta.blocks[p]) {
+            return ["t/" + name + ".json"];
+        }
+        var files = [];
+        for (var k = 0; k < meta.blocks[p]; k++) {
+            files.push("t/" + name + "-" + k + ".json");
+        }
+        return files;
+    }
+
+    return function (query, limit) {
+        limit = limit || 20;
+        var terms = tokenize(query);
+        if (!terms.length) {
+            return Promise.resolve([]);
+        }
+        var meta;
+        return fetchJSON("meta.json").then(function (m) {
+            meta = m;
+            return Promise.all(terms.map(function (term) {
+                return Promise.all(shardFiles(term, meta).map(fetchJSON)).then(function (shards) {
+                    return [].concat.apply([], shards.map(function (shard) {
+                        return (shard && shard[term]) || [];
+                    }));
+                });
+            }));
+        }).then(function (postings) {
+            // Documents having every term, scored by the sum of their weights
+            var scores = {};
+            postings.forEach(function (flat, i) {
+                var next = {};
+                for (var j = 0; j < flat.length; j += 2) {
+                    if (i === 0 || flat[j] in scores) {
+                        next[flat[j]] = (scores[flat[j]] || 0) + flat[j + 1];
+                    }
+                }
+                scores = next;
+            });
+            var ids = Object.keys(scores).sort(function (a, b) {
+                return scores[b] - scores[a];
+            }).slice(0, limit);
+            return Promise.all(ids.map(function (id) {
+                var n = meta.docs_per_shard;
+                return fetchJSON("d/" + Math.floor(id / n) + ".json").then(function (docs) {
+                    var doc = docs[id % n];
+                    return {path: doc[0], title: doc[1], summary: doc[2], score: scores[id]};
+                });
+            }));
+        });
+    };
+})();
@@ -1,8 +1,16 @@
 import codecs
+import collections
 import datetime
 import decimal
+import errno
+import fnmatch
+import hashlib
+import itertools
 import json
+import os
 import os.path
+import shutil
+import tempfile
 import time
 
 from fabric.api import env
@@ -53,6 +61,11 @@ class paths(object):
     def site_dir(*args):
         return os.path.join(env['otto.home'], env['otto.path.sites'], env['otto.site'], *args)
 
+    @staticmethod
+    def cache_dir(*args):
+        """Return a path under the local cache dir, where builds keep state between runs."""
+        return paths.local_workspace(env['otto.cache_dir'], *args)
+
 
 def make_timestamp():
     return datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S')
@@ -79,10 +92,152 @@ def slurp(filename):
         text = f.read()
     return text
 
+def digest(filename):
+    """Return the SHA-1 hex digest of a file's content."""
+    sha = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(65536), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def same_stat(a, b):
+    """True if two stat results have the same size and (near enough) the same mtime.
+
+    Copies only keep the mtime to the microsecond, so compare to the millisecond.
+    """
+    return a.st_size == b.st_size and abs(a.st_mtime - b.st_mtime) < 0.001
+
+# ioctl to clone a file's extents on copy-on-write file systems (btrfs, xfs)
+FICLONE = 0x40049409
+def copy_file(src, dst, link=None):
+    """Copy `src` to `dst` with its mode and mtime, replacing `dst`.
+
+    `link` may be "hardlink" to hard link instead of copy, or "reflink" to
+    share the data blocks on file systems that support it. Either falls back
+    to a plain copy if the file system cannot do it. `dst` is unlinked first,
+    never written in place, so a hard link to `src` left by a previous copy
+    is never written through.
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif link == 'reflink':
+        try:
+            import fcntl
+            with open(src, 'rb') as s:
+                with open(dst, 'wb') as d:
+                    fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            shutil.copystat(src, dst)
+            return
+        except (ImportError, IOError, OSError):
+            pass
+    shutil.copy2(src, dst)
+
+def sync_tree(source, dest, previous=(), link=None, nolink=()):
+    """Make `dest` a copy of the directory `source`, like `cp -a` or `rsync -a`.
+
+    Files already in `dest` with the same size and mtime are skipped. Files
+    are copied, or linked as per `link` (see `copy_file`) unless their name
+    matches one of the `nolink` patterns. Symbolic links are copied as links.
+
+    `previous` is the list returned by the last sync into `dest`. Files in it
+    that no longer exist in `source` are deleted from `dest`. Other files in
+    `dest` are left alone.
+
+    Returns the list of files synced, relative to `dest`.
+    """
+    synced = []
+    for thisdir, subdirs, files in os.walk(source):
+        reldir = os.path.relpath(thisdir, source)
+        destdir = os.path.normpath(os.path.join(dest, reldir))
+        if not os.path.isdir(destdir):
+            os.makedirs(destdir)
+        names = files + [ d for d in subdirs if os.path.islink(os.path.join(thisdir, d)) ]
+        for name in names:
+            src = os.path.join(thisdir, name)
+            dst = os.path.join(destdir, name)
+            synced.append(os.path.normpath(os.path.join(reldir, name)))
+            if os.path.islink(src):
+                target = os.readlink(src)
+                if not os.path.islink(dst) or os.readlink(dst) != target:
+                    if os.path.lexists(dst):
+                        os.remove(dst)
+                    os.symlink(target, dst)
+                continue
+            if os.path.exists(dst) and not os.path.islink(dst) and \
+                    same_stat(os.stat(src), os.stat(dst)):
+                continue
+            if [ p for p in nolink if fnmatch.fnmatch(name, p) ]:
+                copy_file(src, dst)
+            else:
+                copy_file(src, dst, link)
+
+    for relpath in set(previous).difference(synced):
+        try:
+            os.remove(os.path.join(dest, relpath))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+    return synced
+
 def dump(text, filename):
-    """Write unicode `text` to `filename` with UTF-8 encoding."""
-    with codecs.open(filename, 'w', 'utf-8') as f:
-        f.write(text)
+    """Write unicode `text` to `filename` with UTF-8 encoding.
+
+    See `dump_iter`, which this shares its behavior with.
+    """
+    return dump_iter([text], filename)
+
+def dump_iter(chunks, filename):
+    """Write an iterable of unicode `chunks` to `filename` with UTF-8 encoding.
+
+    Each chunk is written as soon as it is produced, so the whole text is
+    never held in memory at once. Chunks go to a temp file next to
+    `filename`, which then replaces it, so readers never see a partly written
+    file. If the new content is identical to the existing file, the existing
+    file is left untouched (mtime included), so tools like rsync see that it
+    did not change.
+
+    Returns True if the file was written, False if it was unchanged.
+    """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(filename) or '.',
+        prefix='.', suffix='.tmp')
+    try:
+        sha = hashlib.sha1()
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                data = chunk.encode('utf-8')
+                sha.update(data)
+                f.write(data)
+        return replace_if_changed(tmpname, filename, sha.hexdigest())
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+# Permissions for new files, as open() would give them
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def replace_if_changed(tmpname, filename, sha1=None):
+    """Rename `tmpname` to `filename`, unless `filename` already has the same
+    content, in which case `tmpname` is removed. `sha1` is the digest of
+    `tmpname`, if already known. Returns True if `filename` was replaced."""
+    if os.path.exists(filename) and \
+            os.path.getsize(filename) == os.path.getsize(tmpname) and \
+            digest(filename) == (sha1 or digest(tmpname)):
+        os.remove(tmpname)
+        return False
+    if os.path.exists(filename):
+        os.chmod(tmpname, os.stat(filename).st_mode & 07777)
+    else:
+        os.chmod(tmpname, 0666 & ~UMASK)
+    os.rename(tmpname, filename)
+    return True
 
 def strip_private_keys(fromdict):
     """Return a shallow copy of the passed dictionary with "private" keys
@@ -94,35 +249,110 @@ def strip_private_keys(fromdict):
         save_copy[k] = v
     return save_copy
 
+def json_scalar(o):
+    """Return the JSON representation of a value the json module does not know,
+    or raise TypeError."""
+    # See "Date Time String Format" in the ECMA-262 specification.
+    if isinstance(o, datetime.datetime):
+        r = o.isoformat()
+        if o.microsecond:
+            r = r[:23] + r[26:]
+        if r.endswith('+00:00'):
+            r = r[:-6] + 'Z'
+        return r
+    elif isinstance(o, datetime.date):
+        return o.isoformat()
+    elif isinstance(o, datetime.time):
+        r = o.isoformat()
+        if o.microsecond:
+            r = r[:12]
+        return r
+    elif isinstance(o, decimal.Decimal):
+        return str(o)
+    elif isinstance(o, time.struct_time):
+        return tuple(o)
+    raise TypeError(repr(o) + " is not JSON serializable")
+
 class Encoder(json.JSONEncoder):
     """JSON encoder that won't choke on feedparser objects."""
     def default(self, o):
-        # See "Date Time String Format" in the ECMA-262 specification.
-        if isinstance(o, datetime.datetime):
-            r = o.isoformat()
-            if o.microsecond:
-                r = r[:23] + r[26:]
-            if r.endswith('+00:00'):
-                r = r[:-6] + 'Z'
-            return r
-        elif isinstance(o, datetime.date):
-            return o.isoformat()
-        elif isinstance(o, datetime.time):
-            r = o.isoformat()
-            if o.microsecond:
-                r = r[:12]
-            return r
-        elif isinstance(o, decimal.Decimal):
-            return str(o)
-        elif isinstance(o, time.struct_time):
-            return tuple(o)
-        else:
+        try:
+            return json_scalar(o)
+        except TypeError:
             return super(Encoder, self).default(o)
 
 
-def json_dump(this, outpath):
-    """Save a dict as JSON to the `outfile` using UTF-8 encoding, removing "private" keys."""
-    dump(json.dumps(strip_private_keys(this), ensure_ascii=False, cls=Encoder, indent=4), outpath)
+JSON_DATES = (datetime.date, datetime.time, time.struct_time)
+def json_ready(o):
+    """Return `o`, or for a dict, its public keys in sorted order, for `json.dumps`.
+
+    "Private" keys are dropped, and dates and times converted as by `Encoder`,
+    at the top level only, where Entries and Channels keep them. Nested values
+    are left to `Encoder`. Sorting only the top level keeps the output the
+    same from build to build without copying every nested dict, and lets the
+    json module's C encoder do the rest.
+    """
+    if not isinstance(o, dict):
+        return o
+    return collections.OrderedDict(
+        (k, json_scalar(v) if isinstance(v, JSON_DATES) else v)
+        for k, v in sorted(o.iteritems()) if not k.startswith('_') )
+
+
+def json_options(pretty=None):
+    """Keyword arguments to `json.dumps` for compact output, or indented if
+    `pretty` (which defaults to `env['otto.pretty_json']`).
+
+    Compact output escapes non-ASCII characters, as only then does the json
+    module encode strings in C. Pretty output is encoded in Python anyway,
+    and sorts keys at every level.
+    """
+    if pretty is None:
+        pretty = env['otto.pretty_json']
+    if pretty:
+        return {'cls': Encoder, 'ensure_ascii': False, 'indent': 4, 'sort_keys': True}
+    return {'cls': Encoder, 'separators': (',', ':')}
+
+def json_dump(this, outpath, pretty=None):
+    """Save a dict as JSON to the `outfile` using UTF-8 encoding, removing "private" keys.
+
+    Output is compact, unless `pretty`, see `json_options`.
+    Returns True if the file changed, see `dump_iter`.
+    """
+    return dump(json.dumps(json_ready(this), **json_options(pretty)), outpath)
+
+def json_dump_items(this, key, items, outpath, pretty=None):
+    """Save `this` as JSON with the list `items` under `key`, like `json_dump`,
+    serializing one item at a time.
+
+    `items` can be any iterable, e.g. a generator loading each item as it is
+    needed, so the items need not all be in memory at once. The output is the
+    same as `json_dump` of `this` with `key` set to the list of `items`, except
+    that the private keys of items are dropped too.
+    """
+    options = json_options(pretty)
+    items = iter(items)
+    first = next(items, None)
+    doc = dict(this)
+    if first is None:
+        doc[key] = []
+        return dump(json.dumps(json_ready(doc), **options), outpath)
+
+    # Lay out a list of two placeholders, to learn how items are separated
+    # and indented at that depth.
+    marker = u'\0otto.util.json_dump_items\0'
+    doc[key] = [marker, marker]
+    head, separator, tail = json.dumps(json_ready(doc), **options).split(json.dumps(marker))
+    indent = separator[separator.rfind('\n'):] if 'indent' in options else None
+    def chunks():
+        yield head
+        sep = u''
+        for item in itertools.chain([first], items):
+            text = json.dumps(json_ready(item), **options)
+            yield sep + (text.replace(u'\n', indent) if indent else text)
+            sep = separator
+        yield tail
+    return dump_iter(chunks(), outpath)
 
 def json_load(filename):
     """Load a JSON object from a file, given the filename."""
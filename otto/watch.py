@@ -0,0 +1,287 @@
+# encoding: UTF-8
+"""Watch mode for otto.blog: rebuild on change and preview in the browser.
+
+The `watch_blog` task builds the blog, serves the build dir over HTTP, and
+then watches the blog source and the template dirs. When a file changes, only
+the changed entries and the channel indexes they appear in are rebuilt (see
+`otto.blog.update_blog`), and every open page reloads itself.
+
+Changes are picked up with inotify when pyinotify is installed, by scanning
+the files every `env['otto.watch.interval']` seconds otherwise.
+
+Set the following keys in your `env` to configure otto.watch:
+
+`otto.watch.host`
+    *Optional.* Default="127.0.0.1". The address the preview server listens on.
+
+`otto.watch.port`
+    *Optional.* Default=8000. The port the preview server listens on.
+
+`otto.watch.interval`
+    *Optional.* Default=1.0. Seconds between scans when polling.
+
+`otto.watch.polling`
+    *Optional.* Default=False. Set to True to poll even if inotify is available,
+    e.g. for network file systems.
+
+"""
+import BaseHTTPServer
+import fnmatch
+import logging
+import os
+import os.path
+import posixpath
+import SimpleHTTPServer
+import socket
+import SocketServer
+import threading
+import time
+import urllib
+
+from fabric.api import env, require, task
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+import otto.blog as blog
+from otto.util import paths
+
+DEFAULT_CONFIG = {
+    'otto.watch.host': '127.0.0.1',
+    'otto.watch.port': 8000,
+    'otto.watch.interval': 1.0,
+    'otto.watch.polling': False,
+    }
+for k, v in DEFAULT_CONFIG.iteritems():
+    env.setdefault(k, v)
+
+# Editor backups, swap files and the like
+IGNORE_PATTERNS = ['.*', '*~', '#*#', '*.swp', '*.tmp']
+
+def ignored(filename):
+    name = os.path.basename(filename)
+    return any(fnmatch.fnmatch(name, p) for p in IGNORE_PATTERNS)
+
+
+#######################################################################
+# Watchers
+#######################################################################
+class PollingWatcher(object):
+    """Watch directory trees by scanning them every `interval` seconds."""
+
+    def __init__(self, dirs, interval=1.0):
+        self.dirs = dirs
+        self.interval = interval
+        self.files = self.scan()
+
+    def scan(self):
+        """Return a dict of each file under the watched dirs to its mtime and size."""
+        files = {}
+        for root in self.dirs:
+            for thisdir, subdirs, names in os.walk(root):
+                subdirs[:] = [ d for d in subdirs if not ignored(d) ]
+                for name in names:
+                    if ignored(name):
+                        continue
+                    filename = os.path.join(thisdir, name)
+                    try:
+                        stat = os.stat(filename)
+                    except OSError: # removed since listed
+                        continue
+                    files[filename] = (stat.st_mtime, stat.st_size)
+        return files
+
+    def wait(self):
+        """Block until files change. Returns the set of files added, changed or removed."""
+        while True:
+            time.sleep(self.interval)
+            files = self.scan()
+            changed = set( f for f in set(files) | set(self.files)
+                if files.get(f) != self.files.get(f) )
+            self.files = files
+            if changed:
+                return changed
+
+
+class InotifyWatcher(object):
+    """Watch directory trees with inotify.
+
+    Events are collected until none arrive for `settle` seconds, so that an
+    editor saving several files (or one file in several steps) causes a
+    single rebuild.
+    """
+
+    def __init__(self, dirs, settle=0.1):
+        self.changed = set()
+        self.manager = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.manager, self.process,
+            timeout=int(settle * 1000))
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+            pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+        for root in dirs:
+            self.manager.add_watch(root, mask, rec=True, auto_add=True)
+
+    def process(self, event):
+        # A created file is reported again when it is closed
+        if event.dir or ignored(event.pathname) or event.mask & pyinotify.IN_CREATE:
+            return
+        self.changed.add(event.pathname)
+
+    def wait(self):
+        """Block until files change. Returns the set of files added, changed or removed."""
+        while True:
+            if self.notifier.check_events():
+                self.notifier.read_events()
+                self.notifier.process_events()
+            elif self.changed:
+                changed, self.changed = self.changed, set()
+                return changed
+
+
+def get_watcher(dirs):
+    if pyinotify and not env['otto.watch.polling']:
+        return InotifyWatcher(dirs)
+    return PollingWatcher(dirs, float(env['otto.watch.interval']))
+
+
+#######################################################################
+# Preview Server
+#######################################################################
+EVENTS_PATH = '/__otto__/events'
+
+# Injected into every HTML page served
+RELOAD_SCRIPT = ('<script>new EventSource("%s").onmessage = '
+    'function () { location.reload(); };</script>' % EVENTS_PATH)
+
+
+class Reloader(object):
+    """Counts builds, and lets request threads wait for the next one."""
+
+    def __init__(self):
+        self.generation = 0
+        self.condition = threading.Condition()
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def wait(self, generation, timeout=None):
+        """Wait until the build after `generation` is done. Returns the current generation."""
+        with self.condition:
+            if self.generation == generation:
+                self.condition.wait(timeout)
+            return self.generation
+
+
+class PreviewHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serves files from the server's `root`, adding the reload script to HTML pages."""
+
+    def translate_path(self, path):
+        path = path.split('?', 1)[0].split('#', 1)[0]
+        path = posixpath.normpath(urllib.unquote(path))
+        words = [ w for w in path.split('/') if w and w not in (os.curdir, os.pardir) ]
+        return os.path.join(self.server.root, *words)
+
+    def do_GET(self):
+        if self.path == EVENTS_PATH:
+            return self.send_events()
+        path = self.translate_path(self.path)
+        if os.path.isdir(path) and self.path.split('?', 1)[0].endswith('/'):
+            path = os.path.join(path, 'index.html')
+        if path.endswith('.html') and os.path.isfile(path):
+            return self.send_page(path)
+        return SimpleHTTPServer.SimpleHTTPRequestHandler.do_GET(self)
+
+    def send_page(self, path):
+        with open(path, 'rb') as f:
+            page = f.read()
+        end = page.rfind('</body>')
+        if end < 0:
+            end = len(page)
+        page = page[:end] + RELOAD_SCRIPT + page[end:]
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(page)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(page)
+
+    def send_events(self):
+        """Server-sent events stream, a "reload" message after each build."""
+        reloader = self.server.reloader
+        generation = reloader.generation
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        try:
+            while True:
+                current = reloader.wait(generation, timeout=15)
+                if current != generation:
+                    self.wfile.write('data: reload\n\n')
+                    generation = current
+                else: # keep alive, and notice closed pages
+                    self.wfile.write(': ping\n\n')
+                self.wfile.flush()
+        except socket.error:
+            pass
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+class PreviewServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, root):
+        BaseHTTPServer.HTTPServer.__init__(self, address, PreviewHandler)
+        self.root = root
+        self.reloader = Reloader()
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+#######################################################################
+# Fab Tasks
+#######################################################################
+@task
+def watch_blog(source_dir, dest_dir, port=None):
+    """Build the blog, serve it locally, and rebuild it as it changes."""
+    require('otto.build_dir', 'otto.site')
+    env['otto.blog.incremental'] = True
+    source = paths.local_workspace(source_dir.rstrip('/'))
+    blog.build_blog(source_dir, dest_dir)
+
+    server = PreviewServer((env['otto.watch.host'], int(port or env['otto.watch.port'])),
+        paths.build_dir(dest_dir))
+    server.start()
+    host, port = server.server_address
+    print "Serving %s at http://%s:%d/" % (paths.build_dir(dest_dir), host, port)
+
+    template_dirs = blog.get_jinja().loader.searchpath
+    watcher = get_watcher([source] + template_dirs)
+    try:
+        while True:
+            changed = watcher.wait()
+            started = time.time()
+            try:
+                if all(f.startswith(source + os.sep) for f in changed):
+                    blog.update_blog(source_dir, dest_dir, changed)
+                else:
+                    blog.build_blog(source_dir, dest_dir)
+            except Exception:
+                logging.exception("Build failed")
+                continue
+            server.reloader.notify()
+            print "Rebuilt %d changed file(s) in %.3fs" % (len(changed), time.time() - started)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
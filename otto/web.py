@@ -25,6 +25,8 @@ Set the following keys in your `env` to configure otto.web:
 
 """
 
+import os.path
+
 from fabric.api import  abort, cd, env, hide, local, prefix, require, run, sudo, task
 from fabric import colors
 import fabric.contrib.files as remotefile
@@ -64,6 +66,47 @@ def _install_etc():
         done
         """ % etclinks)
 
+# The change set of a stage, kept in the root of the deployment
+CHANGES_FILE = '.otto-changes'
+
+def _link_base():
+    """The deployment a new stage can hardlink unchanged files from: the one
+    staged last, or failing that the current one. None for the first stage."""
+    with cd(paths.site_dir()):
+        with hide('running', 'stdout'):
+            base = run('for link in staged current; do '
+                '[ -d $link ] && readlink $link && break; done; true')
+    return base.strip() or None
+
+def _stage_commands(build_dir, stage_dir, base, changes):
+    """The shell commands that copy `build_dir` to `stage_dir`, hard linking
+    the files unchanged since the deployment dir `base` (if any), and record
+    the change set in `changes`, in the root of the stage dir."""
+    exclude = '--exclude=/' + CHANGES_FILE
+    commands = ['echo "base: %s" > %s' % (base and os.path.basename(base) or 'none', changes)]
+    if base:
+        # List what is gone since the base, without comparing any files
+        commands.append('rsync -a %s --dry-run --delete --existing --ignore-existing '
+            '--itemize-changes %s %s/ | grep "^\\*deleting" >> %s; true'
+            % (exclude, build_dir, base, changes))
+        commands.append('rsync -a %s --checksum --no-times --link-dest=%s --itemize-changes '
+            '%s %s >> %s' % (exclude, base, build_dir, stage_dir, changes))
+    else:
+        commands.append('rsync -a %s --itemize-changes %s %s >> %s'
+            % (exclude, build_dir, stage_dir, changes))
+    return commands
+
+def _changes_summary(link):
+    """Summarize the change set of the deployment `link` points to, or None
+    if it has none (it was staged before Otto recorded them)."""
+    changes = paths.site_dir(link, CHANGES_FILE)
+    with hide('running', 'stdout'):
+        summary = run("if test -f %s; then awk '/^base:/ { base = $2 } /^>f/ { w++ } "
+            "/^\\*deleting/ { d++ } END { printf \"%%d written, %%d removed\", w, d; "
+            "if (base != \"none\") printf \" since %%s\", base }' %s; fi"
+            % (changes, changes))
+    return summary.strip() or None
+
 #######################################################################
 # Fab Tasks
 #######################################################################
@@ -78,8 +121,15 @@ def stage(target=None):
     does the right thing!
 
     Otto then uses rsync to copy the content to a staging directory from which
-    it can be deployed. If necessary, Otto will setup Otto on your server, and
-    add the otto remote to your local repo.
+    it can be deployed. Files identical to those of the last staged (or else
+    the current) deployment are hard linked to them rather than copied, so
+    only the files that changed are written, and each deployment takes only
+    the disk space of its changes. Files are compared by content, as the build
+    at the server starts from scratch, and keep the modification time of the
+    deployment they are linked from. The files written and removed are
+    recorded in `.otto-changes` in the deployment, and reported by `list`. If
+    necessary, Otto will setup Otto on your server, and add the otto remote to
+    your local repo.
 
     If no tag name is supplied as an argument, Otto will attempt to tag the
     HEAD of the current branch, or if you are operating with a detached HEAD
@@ -134,8 +184,11 @@ def stage(target=None):
             if has_clean.succeeded:
                 run('fab clean')
             run('fab build')
+        base = _link_base()
         run('mkdir -p ' + stage_dir)
-        run('rsync -a %s %s' % (build_dir, stage_dir))
+        for command in _stage_commands(build_dir, stage_dir, base and paths.site_dir(base),
+                paths.site_dir(deploy_ts, CHANGES_FILE)):
+            run(command)
         with cd(paths.site_dir()):
             run('ln -sfn %s staged' % deploy_ts)
 
@@ -207,7 +260,13 @@ def list():
             available = run('ls -d [0123456789]* | sort')
 
         print colors.green("Current: %s" % current)
+        summary = current != 'None' and _changes_summary('current')
+        if summary:
+            print "  %s" % summary
         print colors.yellow("Staged: %s" % staged)
+        summary = staged != 'None' and _changes_summary('staged')
+        if summary:
+            print "  %s" % summary
         print colors.red("Previous: %s" % previous)
         print "Available:\n%s" % available
 
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""Benchmarks for otto.blog.
+
+Generates a synthetic blog of a given size and shape, builds it with
+`build_blog` and records how long each build took, in total and per phase (as
+reported by `otto.instrument`). Results are appended as one JSON object per
+line to a results file, so runs before and after a change can be compared.
+
+Generate a corpus and benchmark it::
+
+    python test/benchmark.py run --entries 10000 --depth 2 --label before
+    # ... make your change ...
+    python test/benchmark.py run --entries 10000 --depth 2 --label after
+    python test/benchmark.py compare before after
+
+Each run builds the blog four times:
+
+`cold`
+    Full build with empty caches and an empty build directory.
+`warm`
+    Full build again, with the caches left by the cold build.
+`noop`
+    Incremental build with nothing changed.
+`one_changed`
+    Incremental build after changing one entry.
+
+Use `--set key=value` to change any `env` setting for the builds, e.g.
+`--set otto.blog.workers=0`. Corpora are generated into `--workdir` (a
+temporary directory by default) and reused if they already exist there.
+"""
+import argparse
+import json
+import logging
+import os
+import os.path
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fabric.api import env
+import otto.blog as blog
+from otto.instrument import stats
+
+
+RESULTS_FILE = 'bench-results.jsonl'
+
+# Entries per directory. Bigger corpora are split into sub-directories.
+ENTRIES_PER_DIR = 1000
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit morbi nunc nibh '
+    'interdum sed imperdiet quis ultrices in nisl donec porttitor porta velit '
+    'congue rhoncus erat iaculis nec aenean consequat ligula ut suscipit lacus '
+    'scelerisque maecenas sapien sem ultricies ullamcorper non lorem nulla').split()
+
+CODE = '''```python
+def fib(n):
+    """Return the n-th Fibonacci number."""
+    a, b = 0, 1
+    for i in range(%d):
+        a, b = b, a + b
+    return a
+```'''
+
+
+#######################################################################
+# Corpus
+#######################################################################
+def channel_dirs(root, depth, fanout):
+    """Yield the directory of every channel in a tree `depth` levels below `root`."""
+    yield root
+    if depth > 0:
+        for i in range(fanout):
+            for d in channel_dirs(os.path.join(root, 'channel%d' % i), depth - 1, fanout):
+                yield d
+
+
+def paragraph(rand, words=60):
+    text = ' '.join(rand.choice(WORDS) for i in range(words))
+    return text[0].upper() + text[1:] + '.'
+
+
+def entry_text(rand, n, tags, paragraphs, code_ratio, start):
+    """Markdown source of the n-th synthetic entry."""
+    date = start + timedelta(minutes=rand.randint(0, 5 * 365 * 24 * 60))
+    lines = [
+        'Title: Entry %d %s' % (n, paragraph(rand, 4)[:-1]),
+        'Summary: %s' % paragraph(rand, 12),
+        'Date: %s' % date.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'Author: Otto Webber',
+        ]
+    if tags:
+        lines.append('Tags: ' + ' '.join('tag%d' % t for t in
+            rand.sample(xrange(tags), min(tags, rand.randint(1, 5)))))
+    body = [ paragraph(rand) for i in range(paragraphs) ]
+    if rand.random() < code_ratio:
+        body.insert(len(body) // 2, CODE % n)
+    return '\n'.join(lines) + '\n\n' + '\n\n'.join(body) + '\n'
+
+
+def generate_blog(root, entries=1000, depth=1, fanout=3, tags=50, paragraphs=5,
+        code_ratio=0.2, seed=0):
+    """Write a synthetic blog of `entries` Markdown entries into `root`.
+
+    Channels are nested `depth` levels deep, with `fanout` sub-channels each.
+    Entries are spread evenly over all channels, `ENTRIES_PER_DIR` per
+    directory at most. Each entry has up to 5 of `tags` tags, and a
+    `code_ratio` fraction of them include a Python code block for codehilite.
+    The same arguments always produce the same blog.
+    """
+    rand = random.Random(seed)
+    start = datetime(2010, 1, 1)
+    channels = list(channel_dirs(root, depth, fanout))
+    for i, dirname in enumerate(channels):
+        os.makedirs(dirname)
+        with open(os.path.join(dirname, 'channel.json'), 'w') as f:
+            json.dump({'title': 'Channel %d' % i}, f)
+
+    made = set()
+    for n in xrange(entries):
+        channel = channels[n % len(channels)]
+        dirname = os.path.join(channel, 'p%04d' % (n // len(channels) // ENTRIES_PER_DIR))
+        if dirname not in made:
+            os.mkdir(dirname)
+            made.add(dirname)
+        with open(os.path.join(dirname, 'entry%d.md' % n), 'w') as f:
+            f.write(entry_text(rand, n, tags, paragraphs, code_ratio, start))
+
+
+def corpus_name(params):
+    return 'blog-' + '-'.join('%s%s' % (k, params[k]) for k in sorted(params))
+
+
+#######################################################################
+# Builds
+#######################################################################
+def setup_env(workdir, settings):
+    """Point otto at a project in `workdir`, building into `workdir/build`."""
+    env['real_fabfile'] = os.path.join(workdir, 'fabfile.py')
+    env['otto.build_dir'] = 'build'
+    env['otto.site'] = 'bench.example.com'
+    env['otto.cache_dir'] = '.otto-cache'
+    env['otto.blog.tag_dir'] = 'tags' # the corpus has tags
+    for key, value in settings.iteritems():
+        env[key] = value
+
+
+def timed_build(name, source):
+    started = time.time()
+    blog.build_blog(source, 'htdocs')
+    elapsed = time.time() - started
+    result = stats.as_dict()
+    result.update(name=name, elapsed=elapsed)
+    logging.warning("%-12s %8.3fs", name, elapsed)
+    return result
+
+
+def benchmark(source, workdir):
+    """Build the blog in `source` in each scenario. Returns a list of results."""
+    incremental = env['otto.blog.incremental']
+    shutil.rmtree(os.path.join(workdir, 'build'), ignore_errors=True)
+    shutil.rmtree(os.path.join(workdir, '.otto-cache'), ignore_errors=True)
+    try:
+        env['otto.blog.incremental'] = False
+        results = [ timed_build('cold', source), timed_build('warm', source) ]
+
+        env['otto.blog.incremental'] = True
+        results.append(timed_build('noop', source))
+
+        changed = os.path.join(source, 'p0000', 'entry0.md')
+        original = open(changed).read()
+        try:
+            with open(changed, 'a') as f:
+                f.write('\nOne more line.\n')
+            results.append(timed_build('one_changed', source))
+        finally:
+            with open(changed, 'w') as f:
+                f.write(original)
+    finally:
+        env['otto.blog.incremental'] = incremental
+    return results
+
+
+def revision():
+    """The git revision of the code being benchmarked, if known."""
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_settings(pairs):
+    settings = {}
+    for pair in pairs:
+        key, value = pair.split('=', 1)
+        try:
+            settings[key] = json.loads(value)
+        except ValueError:
+            settings[key] = value
+    return settings
+
+
+#######################################################################
+# Commands
+#######################################################################
+def cmd_generate(args):
+    generate_blog(args.dest, entries=args.entries, depth=args.depth, fanout=args.fanout,
+        tags=args.tags, paragraphs=args.paragraphs, code_ratio=args.code_ratio,
+        seed=args.seed)
+
+
+def cmd_run(args):
+    params = dict(entries=args.entries, depth=args.depth, fanout=args.fanout,
+        tags=args.tags, paragraphs=args.paragraphs, code_ratio=args.code_ratio,
+        seed=args.seed)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='otto-bench-'))
+    source = os.path.join(workdir, corpus_name(params))
+    if not os.path.isdir(source):
+        logging.warning("Generating %s", source)
+        started = time.time()
+        generate_blog(source, **params)
+        logging.warning("Generated in %.3fs", time.time() - started)
+
+    settings = parse_settings(args.set)
+    setup_env(workdir, settings)
+    record = {
+        'label': args.label,
+        'when': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': blog.multiprocessing.cpu_count(),
+        'corpus': params,
+        'settings': settings,
+        'runs': benchmark(source, workdir),
+        }
+    with open(args.results, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+    if not args.workdir:
+        shutil.rmtree(workdir)
+
+
+def load_results(filename):
+    with open(filename) as f:
+        return [ json.loads(line) for line in f if line.strip() ]
+
+
+def find_result(results, label):
+    """The latest result with the given label (or revision)."""
+    for record in reversed(results):
+        if label in (record['label'], record['revision']):
+            return record
+    raise SystemExit("No result labeled %r" % label)
+
+
+def compare(before, after):
+    """Return a table comparing two results, as a string."""
+    lines = ["%-28s %10s %10s %8s" % ('', before['label'] or before['revision'],
+        after['label'] or after['revision'], 'ratio')]
+    if before['corpus'] != after['corpus']:
+        lines.append("WARNING: results are for different corpora")
+    after_runs = dict( (r['name'], r) for r in after['runs'] )
+    for old in before['runs']:
+        new = after_runs.get(old['name'])
+        if not new:
+            continue
+        rows = [(old['name'], old['elapsed'], new['elapsed'])]
+        for phase in sorted(set(old['phases']) | set(new['phases'])):
+            rows.append(('  ' + phase, old['phases'].get(phase, 0), new['phases'].get(phase, 0)))
+        for name, a, b in rows:
+            ratio = '%7.2fx' % (b / a) if a else ''
+            lines.append("%-28s %9.3fs %9.3fs %8s" % (name, a, b, ratio))
+    return '\n'.join(lines)
+
+
+def cmd_compare(args):
+    results = load_results(args.results)
+    print compare(find_result(results, args.before), find_result(results, args.after))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark otto.blog builds.")
+    parser.add_argument('--results', default=RESULTS_FILE,
+        help="JSON lines file of results (default: %(default)s)")
+    commands = parser.add_subparsers()
+
+    corpus = argparse.ArgumentParser(add_help=False)
+    corpus.add_argument('--entries', type=int, default=1000)
+    corpus.add_argument('--depth', type=int, default=1, help="levels of nested channels")
+    corpus.add_argument('--fanout', type=int, default=3, help="sub-channels per channel")
+    corpus.add_argument('--tags', type=int, default=50, help="distinct tags")
+    corpus.add_argument('--paragraphs', type=int, default=5, help="paragraphs per entry")
+    corpus.add_argument('--code-ratio', type=float, default=0.2,
+        help="fraction of entries with a code block")
+    corpus.add_argument('--seed', type=int, default=0)
+
+    generate = commands.add_parser('generate', parents=[corpus],
+        help="write a synthetic blog")
+    generate.add_argument('dest')
+    generate.set_defaults(func=cmd_generate)
+
+    run = commands.add_parser('run', parents=[corpus], help="benchmark builds")
+    run.add_argument('--label', help="name for this result")
+    run.add_argument('--workdir', help="where to keep corpora and builds")
+    run.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+        help="env setting for the builds")
+    run.set_defaults(func=cmd_run)
+
+    cmp = commands.add_parser('compare', help="compare two results")
+    cmp.add_argument('before', help="label or revision")
+    cmp.add_argument('after', help="label or revision")
+    cmp.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,16 @@ try:
     import unittest2 as unittest
 except ImportError:
     import unittest
+import datetime
+import json
+import multiprocessing.pool
 import os.path
+import re
+import shutil
+import tempfile
 
+from dateutil import tz
+from fabric.api import env
 import otto.blog as blog
 
 test_dir = os.path.dirname(__file__)
@@ -13,38 +21,479 @@ class BlogTest(unittest.TestCase):
 
     blog_dir = os.path.join(test_dir, 'blog')
     channel_file = os.path.join(test_dir, 'blog', 'channel.json')
-    blog_url = 'http://example.com/blog/'
     fake_path = os.path.join(test_dir, 'does_not_exist')
 
+    def setUp(self):
+        # A project whose blog is built into htdocs/blog
+        self.root = tempfile.mkdtemp()
+        self.built_dir = os.path.join(self.root, 'htdocs', 'blog')
+        shutil.copytree(self.blog_dir, self.built_dir)
+        env['real_fabfile'] = os.path.join(self.root, 'fabfile.py')
+        env['otto.build_dir'] = '.'
+        env['otto.site'] = 'example.com'
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
     def test_load_channel_as_dir(self):
-        """load_channel when passed a directory"""
-        channel = blog.load_channel(self.blog_dir, self.blog_dir, self.blog_url)
+        """Channel.load_json when passed a directory"""
+        channel = blog.Channel.load_json(self.built_dir)
         self.assertEqual(channel['title'], 'Test Title')
-        self.assertEqual(channel['_path'], '.')
-        self.assertEqual(channel['_url'], 'http://example.com/blog/')
+        self.assertEqual(channel.url(), 'blog/')
+        self.assertEqual(channel.url(absolute=True), 'http://example.com/blog/')
 
     def test_load_channel_as_file(self):
-        """load_channel when passed a file"""
-        channel = blog.load_channel(self.channel_file, self.blog_dir, self.blog_url)
+        """Channel.load_json when passed a file"""
+        channel = blog.Channel.load_json(self.channel_file)
         self.assertEqual(channel['title'], 'Test Title')
-        self.assertEqual(channel['_path'], '.')
-        self.assertEqual(channel['_url'], 'http://example.com/blog/')
+        self.assertEqual(channel['_contentfile'], os.path.join(self.blog_dir, 'index.json'))
 
     def test_load_channel_invalid_path(self):
-        """load_channel when passed an invalid path"""
-        with self.assertRaises(ValueError):
-            blog.load_channel(self.fake_path, test_dir, self.blog_url)
+        """Channel.load_json when passed an invalid path"""
+        with self.assertRaises(IOError):
+            blog.Channel.load_json(self.fake_path)
 
     def test_load_entry_markdown(self):
         """Markdown metadata and content parsed to dict."""
-        entry_path = os.path.join(test_dir, 'blog', 'entry.md')
-        entry = blog.load_entry_markdown(entry_path)
+        entry_path = os.path.join(self.built_dir, 'entry.md')
+        entry = blog.Entry.load_markdown(entry_path)
         self.assertEqual(entry['title'], 'Test Entry')
         self.assertEqual(entry['summary'], 'This is a test entry.')
-        self.assertEqual(entry['date'], '2011-09-13T11:00:00+00:00')
+        self.assertEqual(entry['date'],
+            datetime.datetime(2011, 9, 13, 11, 0, tzinfo=tz.tzutc()))
         # Path relative to channel, minus extension:
-        self.assertEqual(entry['_path'], 'entry')
-        self.assertTrue( entry['content'].startswith('<p>Lorem ipsum'))
+        self.assertEqual(entry.url(), 'entry')
+        self.assertEqual(entry.url('html', absolute=True), 'http://example.com/blog/entry.html')
+        self.assertTrue( entry['content'][0]['value'].startswith('<p>Lorem ipsum'))
+
+
+class DatetimeTest(unittest.TestCase):
+
+    def test_parse_datetime(self):
+        """ISO-8601 fast path agrees with dateutil."""
+        self.assertEqual(blog.parse_datetime('2011-09-13T11:00:00.5-04:30'),
+            datetime.datetime(2011, 9, 13, 11, 0, 0, 500000, tzinfo=tz.tzoffset(None, -16200)))
+        self.assertEqual(blog.parse_datetime('2011-09-13T11:00:00Z'),
+            datetime.datetime(2011, 9, 13, 11, 0, tzinfo=tz.tzutc()))
+        self.assertEqual(blog.parse_datetime('2011-09-15').tzinfo, blog.local_tz)
+        self.assertEqual(blog.parse_datetime('Sep 15, 2011'), blog.parse_datetime('2011-09-15'))
+        self.assertRaises(ValueError, blog.parse_datetime, '2011-02-30')
+
+class EntryInputsTest(unittest.TestCase):
+
+    def test_entry_inputs(self):
+        """JSON written for Markdown entries and channel files are not inputs."""
+        files = ['b.md', 'b.json', 'a.json', 'channel.json', 'index.json', 'c.md', 'x.png']
+        self.assertEqual(blog.entry_inputs('d', files),
+            ['d/a.json', 'd/b.md', 'd/c.md'])
+
+class IndexTest(unittest.TestCase):
+
+    def test_newest(self):
+        """Top-N selection returns an ascending run."""
+        self.assertEqual(blog.newest([5, 1, 4, 2], 3), [2, 4, 5])
+        self.assertEqual(blog.newest([5, 1, 4, 2]), [1, 2, 4, 5])
+
+    def test_push_newest(self):
+        """A bounded heap keeps the largest items pushed."""
+        heap = []
+        for item in [5, 1, 4, 2, 6]:
+            blog.push_newest(heap, item, 3)
+        self.assertEqual(sorted(heap), [4, 5, 6])
+
+    def test_merge_newest(self):
+        """Merging runs keeps the largest items of all runs."""
+        self.assertEqual(blog.merge_newest([[1, 6], [2, 3, 7], [5]], 3), [5, 6, 7])
+        self.assertEqual(blog.merge_newest([[1, 6], [2]]), [1, 2, 6])
+
+class TagTest(unittest.TestCase):
+
+    def test_tag_slug(self):
+        """Tags make file names, distinct ones for distinct tags."""
+        self.assertEqual(blog.tag_slug(u'python'), u'python')
+        self.assertEqual(blog.tag_slug(u'node.js'), u'node.js')
+        self.assertTrue(blog.tag_slug(u'c#').startswith(u'c-'))
+        self.assertNotEqual(blog.tag_slug(u'c#'), blog.tag_slug(u'c?'))
+        self.assertNotEqual(blog.tag_slug(u'../x'), u'../x')
+
+    def test_tag_terms(self):
+        """Tags are case insensitive, and an empty tags header means none."""
+        entry = blog.Entry(tags=[{'term': 'Python'}, {'term': 'python'}, {'term': 'web'}])
+        self.assertEqual(blog.tag_terms(entry), set(['python', 'web']))
+        self.assertEqual(blog.tag_terms(blog.Entry(tags=[{'term': ''}])), set())
+
+
+class EntrySummaryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        env['real_fabfile'] = os.path.join(self.root, 'fabfile.py')
+        env['otto.build_dir'] = '.'
+        env['otto.site'] = 'example.com'
+        self.blog_dir = os.path.join(self.root, 'htdocs', 'blog')
+        os.makedirs(self.blog_dir)
+        with open(os.path.join(self.blog_dir, 'channel.json'), 'w') as f:
+            json.dump({'title': 'Blog'}, f)
+        blog.registry = blog.ChannelRegistry(self.blog_dir)
+
+    def tearDown(self):
+        blog.registry = None
+        blog.release_entries()
+        shutil.rmtree(self.root)
+
+    def test_summary(self):
+        """Summaries answer for their entry, loading it only when needed."""
+        entry_file = os.path.join(self.blog_dir, 'entry.json')
+        with open(entry_file, 'w') as f:
+            json.dump({'title': 'Entry', 'updated': '2012-01-02T03:04:05Z',
+                'content': [{'value': '<p>Body</p>', 'type': 'text/html'}]}, f)
+        entry = blog.Entry.load_json(entry_file)
+        summary = blog.EntrySummary(entry)
+        self.assertEqual(summary.title, entry['title'])
+        self.assertEqual(summary.url('html', absolute=True), entry.url('html', absolute=True))
+        self.assertEqual(summary.sort_date(), entry.sort_date())
+        self.assertTrue(summary._entry is None)
+        self.assertEqual(summary.bodycontent(), entry.bodycontent())
+        self.assertEqual(summary['updated'], entry['updated'])
+        self.assertRaises(AttributeError, getattr, summary, 'author_detail')
+        blog.release_entries()
+        self.assertTrue(summary._entry is None)
+
+
+class ChannelRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        env['real_fabfile'] = os.path.join(test_dir, 'fabfile.py')
+        env['otto.build_dir'] = '.'
+        env['otto.site'] = 'example.com'
+
+    def test_channel_for(self):
+        """Entries in sub-directories find the nearest channel."""
+        blog_dir = os.path.join(test_dir, 'blog')
+        registry = blog.ChannelRegistry(blog_dir)
+        self.assertEqual(registry.keys(), [blog_dir])
+        entry_file = os.path.join(blog_dir, 'category1', 'firstentry.json')
+        self.assertTrue(registry.channel_for(entry_file) is registry[blog_dir])
+        self.assertEqual(registry[blog_dir]['title'], 'Test Title')
+        self.assertEqual(registry.channel_for(test_dir), None)
+
+
+class ChannelUrlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        env['real_fabfile'] = os.path.join(self.root, 'fabfile.py')
+        env['otto.build_dir'] = '.'
+        env['otto.site'] = 'example.com'
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def channel(self, *path):
+        metafile = os.path.join(self.root, 'htdocs', *(path + ('channel.json',)))
+        return blog.Channel({'_metafile': metafile})
+
+    def test_url(self):
+        """Channel URLs are the channel's path under htdocs."""
+        channel = self.channel('blog', 'category1')
+        self.assertEqual(channel.url(), 'blog/category1/')
+        self.assertEqual(channel.url(absolute=True), 'http://example.com/blog/category1/')
+        self.assertEqual(channel['_path'], 'blog/category1')
+        self.assertEqual(channel.url('atom', absolute=True),
+            'http://example.com/blog/category1/index.atom')
+
+    def test_root_url(self):
+        channel = self.channel()
+        self.assertEqual(channel.url(absolute=True), 'http://example.com/')
+
+
+class BuildManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.manifest_file = os.path.join(self.root, 'cache', 'manifest.json')
+        self.entry_file = os.path.join(self.root, 'entry.md')
+        with open(self.entry_file, 'w') as f:
+            f.write('title: Test\n\nBody')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_input_changed(self):
+        """Inputs are unchanged after a save unless their content changes."""
+        manifest = blog.BuildManifest(self.manifest_file, self.root)
+        self.assertTrue(manifest.requires_full_build())
+        self.assertTrue(manifest.input_changed(self.entry_file))
+        manifest['inputs']['entry.md'] = dict(manifest._stats['entry.md'],
+            templates={}, outputs=[])
+        manifest.save()
+
+        manifest = blog.BuildManifest(self.manifest_file, self.root)
+        self.assertFalse(manifest.input_changed(self.entry_file))
+
+        # Touching the file without changing it is not a change
+        os.utime(self.entry_file, (0, 0))
+        manifest = blog.BuildManifest(self.manifest_file, self.root)
+        self.assertFalse(manifest.input_changed(self.entry_file))
+
+        with open(self.entry_file, 'a') as f:
+            f.write(' changed')
+        manifest = blog.BuildManifest(self.manifest_file, self.root)
+        self.assertTrue(manifest.input_changed(self.entry_file))
+
+    def test_stale_formats(self):
+        """Only formats whose output is missing need rendering again."""
+        manifest = blog.BuildManifest(self.manifest_file, self.root)
+        manifest.input_changed(self.entry_file)
+        with open(os.path.join(self.root, 'entry.atom'), 'w') as f:
+            f.write('<feed/>')
+        manifest['inputs']['entry.md'] = dict(manifest._stats['entry.md'],
+            templates={'html': ['entry.html'], 'atom': ['atom.jinja', 'entry.atom']},
+            outputs=['entry.html', 'entry.atom'])
+        manifest.save()
+
+        manifest = blog.BuildManifest(self.manifest_file, self.root)
+        self.assertEqual(manifest.stale_formats(self.entry_file, ['html', 'atom']), ['html'])
+
+
+class UpdateBlogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.root, 'blog')
+        shutil.copytree(os.path.join(test_dir, 'blog'), self.source_dir)
+        env['real_fabfile'] = os.path.join(self.root, 'fabfile.py')
+        env['otto.build_dir'] = 'build'
+        env['otto.site'] = 'example.com'
+        env['otto.blog.incremental'] = True
+
+    def tearDown(self):
+        env['otto.blog.incremental'] = False
+        shutil.rmtree(self.root)
+
+    def test_update_entry(self):
+        """A changed entry is rendered and the channel index lists it."""
+        blog.build_blog(self.source_dir, 'htdocs')
+        entry_file = os.path.join(self.source_dir, 'category1', 'firstentry.md')
+        with open(entry_file) as f:
+            text = f.read().replace('title: First Entry', 'title: Edited Entry')
+        with open(entry_file, 'w') as f:
+            f.write(text)
+
+        blog.update_blog(self.source_dir, 'htdocs', [entry_file])
+        built_dir = os.path.join(self.root, 'build', 'htdocs', 'blog')
+        index = json.load(open(os.path.join(built_dir, 'index.json')))
+        self.assertTrue('Edited Entry' in [ e['title'] for e in index['entries'] ])
+        self.assertTrue('Edited Entry' in open(os.path.join(built_dir, 'index.html')).read())
+        self.assertTrue('Edited Entry' in
+            open(os.path.join(built_dir, 'category1', 'firstentry.html')).read())
+
+    def test_rerender_undated_entry(self):
+        """An entry rendered again from its JSON is dated like in a full build."""
+        source_dir = os.path.join(self.root, 'undated')
+        os.mkdir(source_dir)
+        shutil.copy(os.path.join(self.source_dir, 'channel.json'), source_dir)
+        for n in range(2):
+            entry_file = os.path.join(source_dir, 'entry%d.md' % n)
+            with open(entry_file, 'w') as f:
+                f.write('title: Entry %d\n\nNo date.\n' % n)
+            os.utime(entry_file, (0, 1577836800 + n * 86400))
+        blog.build_blog(source_dir, 'htdocs')
+        built_dir = os.path.join(self.root, 'build', 'htdocs', 'undated')
+        html = open(os.path.join(built_dir, 'entry0.html')).read()
+        atom = open(os.path.join(built_dir, 'entry1.atom')).read()
+        self.assertTrue('2020-01-01T00:00:00' in html)
+
+        os.remove(os.path.join(built_dir, 'entry0.html'))
+        os.remove(os.path.join(built_dir, 'entry1.atom'))
+        blog.build_blog(source_dir, 'htdocs')
+        self.assertEqual(open(os.path.join(built_dir, 'entry0.html')).read(), html)
+        self.assertEqual(open(os.path.join(built_dir, 'entry1.atom')).read(), atom)
+
+    def test_noop_build(self):
+        """An incremental build with nothing to do leaves channel.json alone."""
+        blog.build_blog(self.source_dir, 'htdocs')
+        channel_file = os.path.join(self.root, 'build', 'htdocs', 'blog', 'channel.json')
+        mtime = os.stat(channel_file).st_mtime
+        blog.build_blog(self.source_dir, 'htdocs')
+        self.assertEqual(os.stat(channel_file).st_mtime, mtime)
+
+    def test_channel_json(self):
+        """channel.json is the source's, whether the channel is rendered by a
+        full or an incremental build."""
+        source = open(os.path.join(self.source_dir, 'channel.json')).read()
+        channel_file = os.path.join(self.root, 'build', 'htdocs', 'blog', 'channel.json')
+        blog.build_blog(self.source_dir, 'htdocs')
+        self.assertEqual(open(channel_file).read(), source)
+
+        with open(os.path.join(self.source_dir, 'entry.md'), 'a') as f:
+            f.write('\nMore.\n')
+        blog.build_blog(self.source_dir, 'htdocs')
+        self.assertTrue('More.' in
+            open(os.path.join(self.root, 'build', 'htdocs', 'blog', 'index.json')).read())
+        self.assertEqual(open(channel_file).read(), source)
+
+    def test_parallel_build(self):
+        """A build in worker processes writes the same files as a serial one."""
+        def build(build_dir, workers):
+            env['otto.build_dir'] = build_dir
+            env['otto.blog.workers'] = workers
+            blog.build_blog(self.source_dir, 'htdocs')
+            # Entry JSON names its source file, in the build dir
+            root = os.path.join(self.root, build_dir)
+            files = {}
+            for thisdir, subdirs, names in os.walk(root):
+                for name in names:
+                    filename = os.path.join(thisdir, name)
+                    with open(filename, 'rb') as f:
+                        files[os.path.relpath(filename, root)] = f.read().replace(root, 'BUILD')
+            return files
+        for name in ['entry.md', os.path.join('category1', 'firstentry.md')]:
+            with open(os.path.join(self.source_dir, name)) as f:
+                text = f.read()
+            with open(os.path.join(self.source_dir, name), 'w') as f:
+                f.write('Tags: python\n' + text)
+        settings = {'otto.blog.tag_dir': 'tags', 'otto.blog.search_dir': 'search',
+            'otto.blog.sitemap': 'sitemap.xml'}
+        env.update(settings)
+        try:
+            serial = build('serial', 1)
+            parallel = build('parallel', 2)
+        finally:
+            for key in list(settings) + ['otto.blog.workers']:
+                env[key] = blog.DEFAULT_CONFIG[key]
+        self.assertTrue(os.path.join('htdocs', 'blog', 'tags', 'python.html') in serial)
+        self.assertEqual(sorted(parallel), sorted(serial))
+        for name in serial:
+            self.assertEqual(parallel[name], serial[name], name)
+
+    def test_failed_build_stops_workers(self):
+        """When an entry fails, the jobs still queued in the pool are dropped."""
+        calls = []
+        class Pool(multiprocessing.pool.Pool):
+            def close(self):
+                calls.append('close')
+                multiprocessing.pool.Pool.close(self)
+            def terminate(self):
+                calls.append('terminate')
+                multiprocessing.pool.Pool.terminate(self)
+        with open(os.path.join(self.source_dir, 'category1', 'bad.md'), 'w') as f:
+            f.write('title: Bad Entry\ndate: not a date\n\nBad.\n')
+        env['otto.blog.workers'] = 2
+        real_pool, blog.multiprocessing.Pool = blog.multiprocessing.Pool, Pool
+        try:
+            self.assertRaises(Exception, blog.build_blog, self.source_dir, 'htdocs')
+        finally:
+            blog.multiprocessing.Pool = real_pool
+            env['otto.blog.workers'] = blog.DEFAULT_CONFIG['otto.blog.workers']
+        self.assertEqual(calls, ['terminate'])
+
+    def test_pretty_json_changed(self):
+        """Switching otto.pretty_json rewrites the JSON of every entry and index."""
+        blog.build_blog(self.source_dir, 'htdocs')
+        env['otto.pretty_json'] = True
+        try:
+            blog.build_blog(self.source_dir, 'htdocs')
+        finally:
+            env['otto.pretty_json'] = False
+        built_dir = os.path.join(self.root, 'build', 'htdocs', 'blog')
+        for name in ['index.json', 'entry.json', os.path.join('category1', 'firstentry.json')]:
+            self.assertTrue(open(os.path.join(built_dir, name)).read().startswith('{\n    '))
+
+    def test_tag_links(self):
+        """Links on tag pages point to the entries, links in tag feeds to the
+        tag indexes."""
+        entry_file = os.path.join(self.source_dir, 'category1', 'firstentry.md')
+        with open(entry_file) as f:
+            text = f.read()
+        with open(entry_file, 'w') as f:
+            f.write('Tags: python\n' + text)
+        env['otto.blog.tag_dir'] = 'tags'
+        try:
+            blog.build_blog(self.source_dir, 'htdocs')
+        finally:
+            env['otto.blog.tag_dir'] = blog.DEFAULT_CONFIG['otto.blog.tag_dir']
+        htdocs = os.path.join(self.root, 'build', 'htdocs')
+        html = open(os.path.join(htdocs, 'blog', 'tags', 'python.html')).read()
+        hrefs = re.findall(r'href="http://example.com/([^"]+)"', html)
+        self.assertEqual(hrefs, ['blog/category1/firstentry.html'])
+        self.assertTrue(os.path.exists(os.path.join(htdocs, *hrefs[0].split('/'))))
+
+        atom = open(os.path.join(htdocs, 'blog', 'tags', 'python.atom')).read()
+        hrefs = re.findall(r'<link rel="(?:alternate|self)" [^>]*href="http://example.com/([^"]+)"',
+            atom)
+        self.assertEqual(hrefs, ['blog/tags/python.html', 'blog/tags/python.json',
+            'blog/tags/python.atom', 'blog/category1/firstentry.html',
+            'blog/category1/firstentry.json'])
+        for href in hrefs:
+            self.assertTrue(os.path.exists(os.path.join(htdocs, *href.split('/'))))
+
+    def test_tag_dir_in_source(self):
+        """A tag dir that holds sources stops the build, rather than skip them."""
+        os.makedirs(os.path.join(self.source_dir, 'tags'))
+        shutil.copy(os.path.join(self.source_dir, 'entry.md'),
+            os.path.join(self.source_dir, 'tags', 'entry.md'))
+        env['otto.blog.tag_dir'] = 'tags'
+        try:
+            self.assertRaises(SystemExit, blog.build_blog, self.source_dir, 'htdocs')
+        finally:
+            env['otto.blog.tag_dir'] = blog.DEFAULT_CONFIG['otto.blog.tag_dir']
+
+
+class TemplateDependenciesTest(unittest.TestCase):
+
+    def test_imports(self):
+        """Imported templates are dependencies."""
+        self.assertEqual(blog.template_dependencies('entry.atom'),
+            set(['entry.atom', 'atom.jinja']))
+        self.assertEqual(blog.template_dependencies('entry.html'), set(['entry.html']))
+
+
+class BytecodeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.template_file = os.path.join(self.root, 'templates', 'page.html')
+        os.mkdir(os.path.dirname(self.template_file))
+        self.write_template('Hello')
+        env['real_fabfile'] = os.path.join(self.root, 'fabfile.py')
+        env['otto.template_dir'] = os.path.dirname(self.template_file)
+        self.cache_dir = blog.paths.cache_dir('jinja')
+        blog.jinja = None
+
+    def tearDown(self):
+        blog.jinja = None
+        del env['otto.template_dir']
+        shutil.rmtree(self.root)
+
+    def write_template(self, text):
+        with open(self.template_file, 'w') as f:
+            f.write(text)
+
+    def render(self):
+        """Render the template in a fresh Environment, as a new build would."""
+        blog.jinja = None
+        return blog.get_jinja().get_template('page.html').render()
+
+    def cache_file(self):
+        names = os.listdir(self.cache_dir)
+        self.assertEqual(len(names), 1) # and no temp file left over
+        return os.path.join(self.cache_dir, names[0])
+
+    def test_cache(self):
+        """Compiled templates are reused until their source changes."""
+        self.assertEqual(self.render(), 'Hello')
+        cache_file = self.cache_file()
+        os.utime(cache_file, (0, 0))
+
+        self.assertEqual(self.render(), 'Hello')
+        self.assertEqual(os.path.getmtime(self.cache_file()), 0)
+
+        self.write_template('Goodbye')
+        self.assertEqual(self.render(), 'Goodbye')
+        self.assertEqual(self.cache_file(), cache_file)
+        self.assertNotEqual(os.path.getmtime(cache_file), 0)
+
 
 if __name__ == '__main__':
     unittest.main()
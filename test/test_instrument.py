@@ -0,0 +1,35 @@
+#!/usr/bin/env python
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from otto.instrument import BuildStats
+
+
+class BuildStatsTest(unittest.TestCase):
+
+    def test_take_and_merge(self):
+        worker = BuildStats()
+        with worker.timer('markdown'):
+            pass
+        worker.count('entries')
+        worker.count('bytes_written', 10)
+        worker.file_time('a.md', 0.5)
+        data = worker.take()
+        self.assertEqual(worker.counters, {})
+
+        parent = BuildStats()
+        parent.count('entries')
+        parent.merge(data)
+        self.assertEqual(parent.counters['entries'], 2)
+        self.assertEqual(parent.counters['bytes_written'], 10)
+        self.assertIn('markdown', parent.phases)
+        self.assertEqual(parent.as_dict()['slowest'], [{'file': 'a.md', 'seconds': 0.5}])
+
+    def test_slowest_are_kept(self):
+        stats = BuildStats()
+        stats.SLOWEST = 2
+        for i in range(5):
+            stats.file_time('%d.md' % i, i)
+        self.assertEqual([ f['file'] for f in stats.as_dict()['slowest'] ], ['4.md', '3.md'])
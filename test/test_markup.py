@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import os.path
+import shutil
+import tempfile
+
+from fabric.api import env
+import markdown
+from markdown.extensions import codehilite
+import otto.blog as blog
+import otto.markup as markup
+from otto.instrument import stats
+
+
+class MarkupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        env['real_fabfile'] = os.path.join(self.root, 'fabfile.py')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_convert_cached(self):
+        """Converted Markdown is cached and the cache returns the same result."""
+        text = u'Title: Caf\xe9\n\nSome *text*.\n'
+        html, meta = markup.convert(text)
+        self.assertEqual(html, u'<p>Some <em>text</em>.</p>')
+        self.assertEqual(meta, {'title': [u'Caf\xe9']})
+        self.assertTrue(os.path.exists(markup.cache_filename(markup.cache_key(text))))
+        self.assertEqual(markup.convert(text), (html, meta))
+
+    def test_read_meta(self):
+        """The header alone gives the same metadata as converting the document."""
+        filename = os.path.join(self.root, 'entry.md')
+        for text in [u'Title: Caf\xe9\r\nTags: a b\n    c\n\nSome *text*.\n',
+                u'No header\nTitle: x\n', u'']:
+            with open(filename, 'wb') as f:
+                f.write(text.encode('utf-8'))
+            self.assertEqual(markup.read_meta(filename), markup.convert(text)[1])
+
+    def test_lazy_markdown(self):
+        """Lazily loaded entries convert their body when it is first needed."""
+        filename = os.path.join(self.root, 'entry.md')
+        with open(filename, 'w') as f:
+            f.write('Title: Lazy\nTags: a b\n\nSome *text*.\n')
+        entry = blog.Entry.load_markdown(filename, lazy=True)
+        self.assertEqual(entry['title'], 'Lazy')
+        self.assertEqual(entry.topic_list(), ['a', 'b'])
+        self.assertFalse('content' in entry)
+        self.assertEqual(entry.bodycontent(), u'<p>Some <em>text</em>.</p>')
+        self.assertEqual(entry, blog.Entry.load_markdown(filename))
+
+    def test_highlight_cached(self):
+        """A code block is highlighted once, whatever document it is in."""
+        code = u'    :::python\n    print "caf\xe9"\n'
+        fenced = u'```python\nprint "caf\xe9"\n```\n'
+        env['otto.blog.markdown_cache'] = False
+        try:
+            html = markup.convert(u'Intro.\n\n' + code)[0]
+            self.assertTrue('class="codehilite"' in html)
+            stats.reset()
+            self.assertEqual(markup.convert(u'Another intro.\n\n' + code)[0],
+                html.replace(u'Intro.', u'Another intro.'))
+            markup.convert(fenced)
+            self.assertEqual(stats.counters['highlight_cache_hits'], 2)
+        finally:
+            env['otto.blog.markdown_cache'] = True
+
+    def test_highlight_cache_scope(self):
+        """Only Otto's conversions use the highlight cache, and only if enabled."""
+        code = u'Intro.\n\n    :::python\n    print "scope"\n'
+        original = codehilite.CodeHilite
+        markup.convert(code)
+        self.assertTrue(codehilite.CodeHilite is original)
+        stats.reset()
+        markdown.Markdown(extensions=['codehilite']).convert(code)
+        self.assertFalse('highlight_cache_hits' in stats.counters)
+
+        env['otto.blog.markdown_cache'] = False
+        env['otto.blog.highlight_cache'] = False
+        try:
+            shutil.rmtree(markup.paths.cache_dir('highlight'))
+            self.assertTrue('class="codehilite"' in markup.convert(code)[0])
+            self.assertFalse(os.path.exists(markup.paths.cache_dir('highlight')))
+        finally:
+            env['otto.blog.markdown_cache'] = True
+            env['otto.blog.highlight_cache'] = True
+
+
+if __name__ == '__main__':
+    unittest.main()
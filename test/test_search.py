@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import json
+import os.path
+import shutil
+import tempfile
+
+from fabric.api import env
+import otto.blog # registers the default template dir
+import otto.search as search
+
+
+class DocumentTest(unittest.TestCase):
+
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize(u'The Zebra, a zebra and 2 Quokkas'),
+            [u'zebra', u'zebra', u'quokkas'])
+
+    def test_document(self):
+        entry = otto.blog.Entry({'title': 'Zebra &amp; quokka', 'summary': 'A zebra'})
+        doc, terms = search.document(entry, '/blog/zebra.html')
+        self.assertEqual(doc, ['/blog/zebra.html', u'Zebra & quokka', 'A zebra'])
+        self.assertEqual(terms, {u'zebra': 7, u'quokka': 5})
+
+    def test_shard_name(self):
+        self.assertEqual(search.shard_name(u'zebra'), u'ze')
+        self.assertEqual(search.shard_name(u'z'), u'z')
+        self.assertEqual(search.shard_name(u'\xe9t\xe9'), '_c3a974')
+        self.assertEqual(search.shard_name(u'zebra', ['ze', 'zeb']), u'zebr')
+        self.assertEqual(search.shard_name(u'ze', ['ze']), u'ze')
+
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.search_dir = os.path.join(self.root, 'search')
+        self.state_file = os.path.join(self.root, 'cache', 'search.json')
+        env['real_fabfile'] = os.path.join(self.root, 'fabfile.py')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def index(self):
+        return search.SearchIndex(self.search_dir, self.state_file)
+
+    def load(self, name):
+        with open(os.path.join(self.search_dir, name)) as f:
+            return json.load(f)
+
+    def test_incremental_update(self):
+        index = self.index()
+        self.assertTrue(index.rebuild)
+        index.add('a', ['/a.html', 'A', ''], {'zebra': 5})
+        index.add('b', ['/b.html', 'B', ''], {'zebu': 1, 'quokka': 2})
+        index.save()
+        self.assertEqual(self.load('t/ze.json'), {'zebra': [0, 5], 'zebu': [1, 1]})
+        self.assertEqual(self.load('d/0.json'), [['/a.html', 'A', ''], ['/b.html', 'B', '']])
+        self.assertTrue(os.path.exists(os.path.join(self.search_dir, 'search.js')))
+
+        # b changes, a is removed
+        index = self.index()
+        self.assertFalse(index.rebuild)
+        self.assertFalse(index.needs('b'))
+        index.add('b', ['/b.html', 'B2', ''], {'quokka': 3})
+        index.save()
+        self.assertFalse(os.path.exists(os.path.join(self.search_dir, 't', 'ze.json')))
+        self.assertEqual(self.load('t/qu.json'), {'quokka': [1, 3]})
+        self.assertEqual(self.load('d/0.json'), [None, ['/b.html', 'B2', '']])
+
+    def test_split_shards(self):
+        """Shards past the limit are split by prefix, then in blocks of ids."""
+        self.limit = search.POSTINGS_PER_SHARD
+        search.POSTINGS_PER_SHARD = 2
+        try:
+            index = self.index()
+            index.add('a', ['/a.html', 'A', ''], {'zebra': 1, 'zebu': 1})
+            index.add('b', ['/b.html', 'B', ''], {'zebra': 2, 'ze': 1})
+            index.add('c', ['/c.html', 'C', ''], {'zebra': 3})
+            index.save()
+            meta = self.load('meta.json')
+            self.assertEqual(meta['split'], ['ze', 'zeb', 'zebr', 'zebra'])
+            self.assertEqual(meta['blocks'], {'zebra': 2})
+            self.assertEqual(self.load('t/ze.json'), {'ze': [1, 1]})
+            self.assertEqual(self.load('t/zebu.json'), {'zebu': [0, 1]})
+            self.assertEqual(self.load('t/zebra-0.json'), {'zebra': [0, 1, 1, 2]})
+            self.assertEqual(self.load('t/zebra-1.json'), {'zebra': [2, 3]})
+            self.assertFalse(os.path.exists(os.path.join(self.search_dir, 't', 'zebra.json')))
+
+            # Documents are cleared from the shards their terms moved to, c goes
+            index = self.index()
+            index.add('a', ['/a.html', 'A', ''], {'quokka': 1})
+            index.add('b')
+            index.save()
+            self.assertEqual(self.load('t/zebra-0.json'), {'zebra': [1, 2]})
+            self.assertFalse(os.path.exists(os.path.join(self.search_dir, 't', 'zebu.json')))
+            self.assertFalse(os.path.exists(os.path.join(self.search_dir, 't', 'zebra-1.json')))
+        finally:
+            search.POSTINGS_PER_SHARD = self.limit
+
+    def test_rebuild_without_search_dir(self):
+        index = self.index()
+        index.add('a', ['/a.html', 'A', ''], {'zebra': 5})
+        index.save()
+        shutil.rmtree(self.search_dir)
+        index = self.index()
+        self.assertTrue(index.rebuild)
+        self.assertTrue(index.needs('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
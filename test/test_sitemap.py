@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+from datetime import datetime
+from dateutil import tz
+import os.path
+import shutil
+import tempfile
+
+import otto.sitemap as sitemap
+
+
+class SitemapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.filename = os.path.join(self.root, 'blog', 'sitemap.xml')
+        self.state_file = os.path.join(self.root, 'cache', 'sitemap.json')
+        self.limit = sitemap.URLS_PER_SITEMAP
+        sitemap.URLS_PER_SITEMAP = 2
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        sitemap.URLS_PER_SITEMAP = self.limit
+
+    def sitemap(self):
+        return sitemap.Sitemap(self.filename, 'http://example.com/blog/sitemap.xml',
+            self.state_file)
+
+    def read(self, name):
+        with open(os.path.join(self.root, 'blog', name)) as f:
+            return f.read()
+
+    def test_w3c_datetime(self):
+        self.assertEqual(sitemap.w3c_datetime(
+            datetime(2012, 5, 29, 5, 7, tzinfo=tz.tzoffset(None, 7200))),
+            '2012-05-29T03:07:00Z')
+        self.assertEqual(sitemap.w3c_datetime(None), None)
+
+    def test_incremental_update(self):
+        sm = self.sitemap()
+        self.assertTrue(sm.rebuild)
+        sm.add('a', 'http://example.com/blog/a.html', datetime(2012, 1, 1))
+        sm.add('b', 'http://example.com/blog/b.html')
+        sm.add('c', 'http://example.com/blog/c&d.html')
+        sm.save()
+        self.assertEqual(self.read('sitemap-0.xml').splitlines()[2:4],
+            ['<url><loc>http://example.com/blog/a.html</loc>'
+             '<lastmod>2012-01-01T00:00:00Z</lastmod></url>',
+             '<url><loc>http://example.com/blog/b.html</loc></url>'])
+        self.assertIn('<loc>http://example.com/blog/c&amp;d.html</loc>', self.read('sitemap-1.xml'))
+        self.assertIn('<loc>http://example.com/blog/sitemap-1.xml</loc>', self.read('sitemap.xml'))
+
+        # c is removed, only the sitemap it was in changes, and goes
+        os.utime(os.path.join(self.root, 'blog', 'sitemap-0.xml'), (0, 0))
+        sm = self.sitemap()
+        self.assertFalse(sm.rebuild)
+        sm.add('a', 'http://example.com/blog/a.html', datetime(2012, 1, 1))
+        sm.add('b', 'http://example.com/blog/b.html')
+        sm.save()
+        self.assertEqual(os.path.getmtime(os.path.join(self.root, 'blog', 'sitemap-0.xml')), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'blog', 'sitemap-1.xml')))
+        self.assertNotIn('sitemap-1.xml', self.read('sitemap.xml'))
+
+
+if __name__ == '__main__':
+    unittest.main()
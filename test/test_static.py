@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import gzip
+import json
+import os
+import os.path
+import shutil
+import tempfile
+
+from fabric.api import env
+import otto.static as static
+
+
+class MinifyTest(unittest.TestCase):
+
+    def test_minify_markup(self):
+        """Indentation between tags goes, except where whitespace matters."""
+        html = u'<div>\n    <p>Some  text</p>\n    <pre>\n  code\n    </pre>\n</div>\n'
+        self.assertEqual(static.minify_markup(html),
+            u'<div>\n<p>Some  text</p>\n<pre>\n  code\n    </pre>\n</div>')
+
+    def test_minify_json(self):
+        self.assertEqual(static.minify_json(u'{\n    "b": [1, 2],\n    "a": "x"\n}'),
+            u'{"b":[1,2],"a":"x"}')
+
+
+class FingerprintTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        env['real_fabfile'] = os.path.join(self.root, 'fabfile.py')
+        env['otto.build_dir'] = 'out'
+        env['otto.site'] = 'example.com'
+        self.htdocs = os.path.join(self.root, 'out', 'htdocs')
+        os.makedirs(os.path.join(self.htdocs, 'css'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, text):
+        with open(os.path.join(self.htdocs, name), 'w') as f:
+            f.write(text)
+
+    def read(self, name):
+        with open(os.path.join(self.htdocs, name)) as f:
+            return f.read()
+
+    def test_rewrite_references(self):
+        lookup = {'css/a b.css': 'css/a b.0123456789.css', 'logo.png': 'logo.abcdef0123.png'}
+        html = (u'<link href="../css/a%20b.css"><img src=\'/logo.png\'>'
+            u'<img src="http://example.com/logo.png?v=1"><img src="http://other.com/logo.png">'
+            u'<p style="background: url(/logo.png)">logo.png</p>')
+        self.assertEqual(static.rewrite_references(html, 'blog/index.html', lookup),
+            u'<link href="../css/a%20b.0123456789.css"><img src=\'/logo.abcdef0123.png\'>'
+            u'<img src="http://example.com/logo.abcdef0123.png?v=1"><img src="http://other.com/logo.png">'
+            u'<p style="background: url(/logo.abcdef0123.png)">logo.png</p>')
+
+    def test_fingerprint_assets(self):
+        """Copies follow their asset's content, and pages follow the copies."""
+        self.write('css/site.css', 'body {}')
+        self.write('index.html', '<link href="css/site.css">')
+        static.fingerprint_assets()
+        manifest = json.load(open(os.path.join(self.root, 'out', 'assets.json')))
+        old = manifest['css/site.css']
+        self.assertTrue(static.FINGERPRINT.match(old))
+        self.assertEqual(self.read(old), 'body {}')
+        self.assertEqual(self.read('index.html'), '<link href="%s">' % old)
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'out',
+            'etc', 'apache2', 'conf.d', 'example.com-assets.conf')))
+
+        self.write('css/site.css', 'body { color: red }')
+        static.fingerprint_assets()
+        manifest = json.load(open(os.path.join(self.root, 'out', 'assets.json')))
+        new = manifest['css/site.css']
+        self.assertNotEqual(new, old)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.htdocs, 'css'))),
+            sorted(['site.css', os.path.basename(new)]))
+        self.assertEqual(self.read('index.html'), '<link href="%s">' % new)
+
+
+class PrecompressTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        env['real_fabfile'] = os.path.join(self.root, 'fabfile.py')
+        env['otto.build_dir'] = 'out'
+        env['otto.static.workers'] = 1
+        self.build_dir = os.path.join(self.root, 'out')
+        os.makedirs(self.build_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+        env['otto.static.workers'] = static.DEFAULT_CONFIG['otto.static.workers']
+
+    def write(self, name, text):
+        with open(os.path.join(self.build_dir, name), 'w') as f:
+            f.write(text)
+
+    def test_precompress(self):
+        """Compressed copies are minified, kept while up to date, and removed with their file."""
+        self.write('index.html', '<html>\n    <body></body>\n</html>\n')
+        self.write('logo.png', 'not text')
+        self.write('gone.html.gz', '')
+        self.write('archive.tar.gz', 'kept')
+        static.precompress()
+        gz = os.path.join(self.build_dir, 'index.html.gz')
+        self.assertEqual(gzip.open(gz).read(), '<html>\n<body></body>\n</html>')
+        self.assertEqual(sorted(os.listdir(self.build_dir)),
+            ['archive.tar.gz', 'index.html', 'index.html.gz', 'logo.png'])
+
+        self.assertEqual(static.compress_jobs(self.build_dir, ['*.html'], ['.gz']), [])
+        os.utime(gz, (0, 0))
+        self.assertEqual(static.compress_jobs(self.build_dir, ['*.html'], ['.gz']),
+            [(os.path.join(self.build_dir, 'index.html'), ['.gz'])])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import datetime
+import json
+import os
+import os.path
+import shutil
+import tempfile
+
+from dateutil import tz
+from otto.util import dump, dump_iter, json_dump, json_dump_items, json_ready, slurp, \
+    sync_tree
+
+
+class DumpTest(unittest.TestCase):
+
+    def test_dump_iter(self):
+        """Chunks are written in order, UTF-8 encoded."""
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            dump_iter((c for c in [u'caf', u'\xe9', u'!']), filename)
+            self.assertEqual(slurp(filename), u'caf\xe9!')
+        finally:
+            os.remove(filename)
+
+    def test_dump_unchanged(self):
+        """Files with identical content are not written again."""
+        dirname = tempfile.mkdtemp()
+        filename = os.path.join(dirname, 'out.html')
+        try:
+            self.assertTrue(dump(u'one', filename))
+            os.utime(filename, (0, 0))
+            self.assertFalse(dump(u'one', filename))
+            self.assertEqual(os.path.getmtime(filename), 0)
+            self.assertTrue(dump(u'two', filename))
+            self.assertEqual(slurp(filename), u'two')
+            self.assertEqual(os.listdir(dirname), ['out.html'])
+        finally:
+            shutil.rmtree(dirname)
+
+class JsonTest(unittest.TestCase):
+
+    def test_json_ready(self):
+        """Top level dates are converted and private keys dropped, in key order."""
+        thing = {
+            'b': datetime.datetime(2012, 1, 2, 3, 4, 5, tzinfo=tz.tzutc()),
+            'a': [{'x': 1}],
+            '_private': 'secret',
+            }
+        self.assertEqual(json.dumps(json_ready(thing), separators=(',', ':')),
+            '{"a":[{"x":1}],"b":"2012-01-02T03:04:05Z"}')
+
+    def test_json_dump(self):
+        """Compact output escapes non-ASCII, pretty output does not."""
+        dirname = tempfile.mkdtemp()
+        filename = os.path.join(dirname, 'out.json')
+        thing = {'title': u'caf\xe9', 'tags': [{'d': datetime.date(2012, 1, 2)}]}
+        try:
+            json_dump(thing, filename, False)
+            self.assertEqual(slurp(filename), u'{"tags":[{"d":"2012-01-02"}],"title":"caf\\u00e9"}')
+            json_dump(thing, filename, True)
+            self.assertTrue(u'"caf\xe9"' in slurp(filename))
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_json_dump_items(self):
+        """Items serialized one by one come out as json_dump would write them,
+        less their private keys."""
+        dirname = tempfile.mkdtemp()
+        filename = os.path.join(dirname, 'out.json')
+        thing = {'title': u'caf\xe9', 'z': 1}
+        items = [{'a': [1, {'b': 2}], '_private': 3}, {'c': u'\n'}]
+        try:
+            for pretty in (False, True):
+                for n in (0, 1, 2):
+                    json_dump(dict(thing, entries=[ json_ready(i) for i in items[:n] ]),
+                        filename, pretty)
+                    expected = slurp(filename)
+                    json_dump_items(thing, 'entries', iter(items[:n]), filename, pretty)
+                    self.assertEqual(slurp(filename), expected)
+        finally:
+            shutil.rmtree(dirname)
+
+class SyncTreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.source = os.path.join(self.root, 'source')
+        self.dest = os.path.join(self.root, 'dest')
+        os.makedirs(os.path.join(self.source, 'sub'))
+        for name in ['a.md', 'sub/b.png']:
+            with open(os.path.join(self.source, name), 'w') as f:
+                f.write(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_sync(self):
+        """Files are copied, then unchanged files are skipped and removed files deleted."""
+        synced = sync_tree(self.source, self.dest)
+        self.assertEqual(sorted(synced), ['a.md', 'sub/b.png'])
+        with open(os.path.join(self.dest, 'a.md')) as f:
+            self.assertEqual(f.read(), 'a.md')
+
+        # Outputs of the build are not touched
+        with open(os.path.join(self.dest, 'a.html'), 'w') as f:
+            f.write('output')
+        os.remove(os.path.join(self.source, 'a.md'))
+        synced = sync_tree(self.source, self.dest, previous=synced)
+        self.assertEqual(synced, ['sub/b.png'])
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'a.md')))
+        self.assertTrue(os.path.exists(os.path.join(self.dest, 'a.html')))
+
+    def test_hardlink(self):
+        """Linked files share the source inode, except files matching `nolink`."""
+        sync_tree(self.source, self.dest, link='hardlink', nolink=['*.md'])
+        self.assertTrue(os.path.samefile(os.path.join(self.source, 'sub', 'b.png'),
+            os.path.join(self.dest, 'sub', 'b.png')))
+        self.assertFalse(os.path.samefile(os.path.join(self.source, 'a.md'),
+            os.path.join(self.dest, 'a.md')))
+
+if __name__ == '__main__':
+    unittest.main()
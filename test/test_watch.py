@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import os
+import os.path
+import shutil
+import socket
+import tempfile
+import urllib2
+
+from otto import watch
+
+
+class PollingWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.filename = os.path.join(self.root, 'entry.md')
+        with open(self.filename, 'w') as f:
+            f.write('title: Test')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_wait(self):
+        """Changed, added and removed files are reported, editor files are not."""
+        watcher = watch.PollingWatcher([self.root], interval=0.01)
+        with open(self.filename, 'a') as f:
+            f.write('\n\nMore text')
+        with open(os.path.join(self.root, '.entry.md.swp'), 'w') as f:
+            f.write('junk')
+        self.assertEqual(watcher.wait(), set([self.filename]))
+        os.remove(self.filename)
+        new_file = os.path.join(self.root, 'new.md')
+        with open(new_file, 'w') as f:
+            f.write('title: New')
+        self.assertEqual(watcher.wait(), set([self.filename, new_file]))
+
+
+class PreviewServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'blog'))
+        with open(os.path.join(self.root, 'blog', 'index.html'), 'w') as f:
+            f.write('<html><body><p>Hello</p></body></html>')
+        self.server = watch.PreviewServer(('127.0.0.1', 0), self.root)
+        self.server.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.root)
+
+    def test_page(self):
+        """HTML pages get the reload script."""
+        page = urllib2.urlopen(self.url + '/blog/').read()
+        self.assertEqual(page, '<html><body><p>Hello</p>%s</body></html>' % watch.RELOAD_SCRIPT)
+
+    def test_events(self):
+        """Open pages are told to reload after a build."""
+        events = socket.create_connection(self.server.server_address, timeout=5)
+        events.sendall('GET %s HTTP/1.0\r\n\r\n' % watch.EVENTS_PATH)
+        response = ''
+        while not response.endswith('\r\n\r\n'):
+            response += events.recv(1)
+        self.assertTrue('text/event-stream' in response)
+        self.server.reloader.notify()
+        self.assertEqual(events.recv(100), 'data: reload\n\n')
+        events.close()
+
+if __name__ == '__main__':
+    unittest.main()
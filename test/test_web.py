@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+from distutils.spawn import find_executable
+import os
+import os.path
+import shutil
+import subprocess
+import tempfile
+
+from otto import web
+
+
+class StageCommandsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.build_dir = os.path.join(self.root, 'build') + '/'
+        self.sites = os.path.join(self.root, 'sites')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def commands(self, name, base=None):
+        stage_dir = os.path.join(self.sites, name)
+        return web._stage_commands(self.build_dir, stage_dir,
+            base and os.path.join(self.sites, base),
+            os.path.join(stage_dir, web.CHANGES_FILE))
+
+    def test_first_stage(self):
+        echo, rsync = self.commands('1')
+        self.assertTrue(echo.startswith('echo "base: none" > '))
+        self.assertTrue('--exclude=/.otto-changes' in rsync)
+        self.assertFalse('--link-dest' in rsync)
+
+    def test_incremental_stage(self):
+        """Unchanged files are linked from the base, and the change set is
+        never taken for a file of the site."""
+        echo, deleted, rsync = self.commands('2', base='1')
+        self.assertTrue(echo.startswith('echo "base: 1" > '))
+        self.assertTrue('--exclude=/.otto-changes' in deleted)
+        self.assertTrue(' %s %s/ ' % (self.build_dir, os.path.join(self.sites, '1')) in deleted)
+        self.assertTrue('--exclude=/.otto-changes' in rsync)
+        self.assertTrue('--link-dest=%s ' % os.path.join(self.sites, '1') in rsync)
+
+    @unittest.skipIf(not find_executable('rsync'), "needs rsync")
+    def test_stage_with_rsync(self):
+        def write(name, text):
+            with open(os.path.join(self.build_dir, name), 'w') as f:
+                f.write(text)
+        def stage(name, base=None):
+            os.makedirs(os.path.join(self.sites, name))
+            for command in self.commands(name, base):
+                subprocess.check_call(command, shell=True)
+            with open(os.path.join(self.sites, name, web.CHANGES_FILE)) as f:
+                return f.read().splitlines()
+        os.makedirs(self.build_dir)
+        write('same.html', 'same')
+        write('changed.html', 'old')
+        write('gone.html', 'gone')
+        stage('1')
+
+        os.remove(os.path.join(self.build_dir, 'gone.html'))
+        write('changed.html', 'new')
+        changes = stage('2', base='1')
+        self.assertEqual(changes[0], 'base: 1')
+        self.assertEqual(sorted( line.split()[-1] for line in changes[1:] ),
+            ['changed.html', 'gone.html'])
+        same = [ os.stat(os.path.join(self.sites, n, 'same.html')).st_ino for n in '12' ]
+        self.assertEqual(same[0], same[1])
+
+
+if __name__ == '__main__':
+    unittest.main()